@@ -156,17 +156,10 @@ def index_contributors(pub):
 
 def get_existing_people():
     logger.info("Getting existing profiles.")
-    q = rq_prefixes + """
-    select ?p
-    where
-    {
-        ?p a foaf:Person
-    }
-    """
     vstore = backend.get_store()
     out = []
-    for row in vstore.query(q):
-        out.append(row.p)
+    for people in vstore.page_keys("?p a foaf:Person .", "p", prefixes=rq_prefixes):
+        out += people
     return out
 
 
@@ -398,11 +391,8 @@ def build_dtu_people():
     """
     logger.info("Adding DTUResearcher type.")
     vstore = backend.get_store()
-    q = rq_prefixes + """
-    CONSTRUCT {
-        ?person a wos:DTUResearcher
-    }
-    WHERE {
+    template = "?person a wos:DTUResearcher"
+    where = """
         d:org-technical-university-of-denmark a wos:UnifiedOrganization ;
                vivo:relatedBy ?address .
         ?address a wos:Address ;
@@ -411,11 +401,12 @@ def build_dtu_people():
         ?authorship a vivo:Authorship ;
                 vivo:relates ?person .
         ?person a foaf:Person .
-    }
     """
-    logger.info("DTU people query:\n" + q)
+    logger.info("DTU people query:\n" + where)
 
-    g = vstore.query(q).graph
+    g = Graph()
+    for triple in vstore.cursor_construct(template, where, "person", prefixes=rq_prefixes):
+        g.add(triple)
     vstore.bulk_add(AFFILIATION_NG, g)
 
 
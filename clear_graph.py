@@ -13,11 +13,18 @@ from lib import backend
 from settings import logger
 
 NG_BASE = "http://localhost/data/"
+# Starting batch size. Kept below the controller's default because
+# larger deletes have drawn 403s from VIVO.
+DEFAULT_BATCH = 4000
 
 
-def process(named_graph, batch, dry=False, sleep=10):
+def process(named_graph, batch=DEFAULT_BATCH, dry=False, sleep=0):
+    controller = backend.get_controller()
+    controller.seed(batch)
     while True:
         vstore = backend.get_store()
+        # Fetch as many triples as the next update will remove.
+        batch = str(controller.size)
         logger.info("Querying {} for triples to remove.".format(named_graph))
         q = """
         CONSTRUCT {
@@ -54,6 +61,6 @@ if __name__ == "__main__":
     parser.add_argument('--dry-run', '-d', action="store_true", dest="dry", default=False, help="Dry run.")
     parser.add_argument('--sleep', '-sp', action="store", default=0, type=int)
     parser.add_argument('--graph', '-g', required=True)
-    parser.add_argument('--batch', '-b', default='4000', type=str)
+    parser.add_argument('--batch', '-b', default=DEFAULT_BATCH, type=int, help="Starting batch size.")
     args = parser.parse_args()
     done = process(args.graph, args.batch, dry=args.dry, sleep=args.sleep)
@@ -52,16 +52,13 @@ def mk_slug(raw):
 
 
 def fetch_vivo_countries():
-    q = rq_prefixes + """
-    SELECT ?uri ?label ?code
-    WHERE {
+    where = """
       ?uri a vivo:Country ;
            rdfs:label ?label ;
            <http://aims.fao.org/aos/geopolitical.owl#codeISO3> ?code .
-    }
     """
     d = {}
-    for row in store.query(q):
+    for row in store.cursor_select("?uri ?label ?code", where, "uri", prefixes=rq_prefixes):
         slug = mk_slug(row.label.toPython())
         d[slug] = row.uri
     return d
@@ -6,6 +6,7 @@ $ python fetch_pubs_xml.py --help
 
 
 import argparse
+from datetime import date
 import sys
 import os
 from string import Template
@@ -16,6 +17,8 @@ import xml.etree.ElementTree as ET
 import json
 
 from lib import wose
+from lib import harvest
+from lib.segments import SegmentStore
 
 from log_setup import get_logger
 
@@ -83,36 +86,152 @@ def get_path(ut, base_path="/tmp/wose2/"):
     fn = os.path.join(path, ut + ".xml")
     return fn
 
+
+def write_page(recs, outd, store=None, manifest=None, incremental=False):
+    """
+    Write a page of records, to the segment store if given and
+    otherwise one file per record. Content hashes go to the manifest
+    if given. With incremental, records already written with the same
+    content are skipped. Returns the number of records written.
+    """
+    written = 0
+    for rec in recs:
+        ut = rec.find('./UID').text
+        raw = ET.tostring(rec)
+        path = None
+        if store is None:
+            path = get_path(ut, base_path=outd)
+        if (incremental is True) and (manifest is not None) and manifest.unchanged(ut, raw):
+            if (path is None) or os.path.exists(path):
+                continue
+        if store is not None:
+            store.put(ut, raw)
+        else:
+            with open(path, 'w') as outfile:
+                outfile.write(raw)
+        if manifest is not None:
+            manifest.put(ut, raw)
+        written += 1
+    if store is not None:
+        store.flush()
+    if manifest is not None:
+        manifest.commit()
+    return written
+
+
+def fetch_query(q, outd, wos, store=None, restart=False, manifest=None, incremental=False):
+    """
+    Harvest one query, resuming from its checkpoint in outd.
+    """
+    checkpoint = harvest.HarvestCheckpoint(harvest.checkpoint_path(outd, q), q)
+    if restart is True:
+        checkpoint.finish()
+        checkpoint = harvest.HarvestCheckpoint(checkpoint.path, q)
+    if (wos.sid is None) and (checkpoint.sid is not None):
+        wos.set_sid(checkpoint.sid)
+    if wos.sid is None:
+        wos.authenticate()
+        logger.info("Session ID: {}.".format(wos.sid))
+    # Write each page as it arrives. The checkpoint is updated once
+    # a page is written, so a rerun picks up after it.
+    fetched = len(checkpoint.uts)
+    for recs in harvest.harvest(q, wos, checkpoint, count=100):
+        written = write_page(recs, outd, store=store, manifest=manifest, incremental=incremental)
+        fetched += len(recs)
+        logger.info("Fetched {} of {} records, wrote {} of this page.".format(fetched, checkpoint.num, written))
+
+
+def fetch_windows(query, start, end, outd, wos, store=None, restart=False, sessions=harvest.WINDOW_WORKERS,
+                  manifest=None, incremental=False):
+    """
+    Harvest a date range as windows, up to sessions of them at a time.
+    """
+    make_query = lambda begin, stop, count: prep_qstring(query, count=count, start=begin, end=stop)
+    plan = harvest.HarvestPlan(outd, make_query(start, end, 100), make_query)
+    if restart is True:
+        plan.finish()
+        plan = harvest.HarvestPlan(outd, plan.query, make_query)
+    if wos.sid is None:
+        wos.authenticate()
+    if plan.windows is None:
+        plan.planned(harvest.plan_windows(make_query, wos, start, end))
+    logger.info("{} records found in {} windows, {} to go.".format(
+        plan.num, len(plan.windows), len(plan.pending())))
+    spare = [wos]
+
+    def new_session():
+        if spare:
+            return spare.pop()
+        session = wose.Session(user=wos.user, password=wos.password)
+        session.authenticate()
+        logger.info("Session ID: {}.".format(session.sid))
+        return session
+
+    def write(recs):
+        written = write_page(recs, outd, store=store, manifest=manifest, incremental=incremental)
+        logger.info("Fetched {} of {} records, wrote {} of this page.".format(
+            len(plan.uts) + len(recs), plan.num, written))
+
+    harvest.harvest_windows(plan, new_session, write, workers=sessions)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Fetch Web of Science Documents')
     parser.add_argument('--session', '-s', default=None, help="WOS session id")
-    parser.add_argument('--start', default=None, required=True, help="Date start. E.g 2012-01-01")
-    parser.add_argument('--end', default=None, required=True, help="Date end. E.g 2012-02-01")
+    parser.add_argument('--start', default=None, help="Date start. E.g 2012-01-01. Required unless --incremental finds an earlier harvest")
+    parser.add_argument('--end', default=None, help="Date end. E.g 2012-02-01. Defaults to the end of an unfinished harvest of the same range, otherwise today")
     parser.add_argument('--query', '-q', required=True)
     parser.add_argument('--out', '-o', default="wos")
+    parser.add_argument('--store', action="store_true", default=False, help="Write to a segment store in --out rather than one file per record")
+    parser.add_argument('--restart', action="store_true", default=False, help="Ignore a checkpoint left by an earlier run of the same query")
+    parser.add_argument('--windows', '-w', action="store_true", default=False, help="Split the date range into month windows, smaller where WoS finds too many records, and harvest them in parallel")
+    parser.add_argument('--sessions', type=int, default=harvest.WINDOW_WORKERS, help="Windows harvested at once with --windows, each with its own WoS session")
+    parser.add_argument('--incremental', '-i', action="store_true", default=False, help="Start from the end of the last complete harvest of the query and don't rewrite unchanged records")
     args = parser.parse_args(sys.argv[1:])
     start_stop = []
     logger.info("Query: {}".format(args.query))
+    # Make output dir
+    outd = make_out_dir(args.out)
+    manifest = harvest.HarvestManifest(os.path.join(outd, harvest.MANIFEST_NAME))
+    if args.incremental is True:
+        # Load dates are whole days, so the last day is fetched again
+        # for records loaded after the last harvest ran.
+        last = manifest.last_harvest(args.query)
+        if last is not None:
+            logger.info("Last harvest of the query ended {}.".format(last))
+            args.start = max(args.start or last, last)
+    if args.start is None:
+        parser.error("--start is required without an earlier harvest of the query")
+    if args.end is None:
+        # Reuse the end of an unfinished run so its checkpoint is found,
+        # rather than starting over with today's date.
+        if args.restart is False:
+            args.end = manifest.unfinished(args.query, args.start)
+        if args.end is not None:
+            logger.info("Resuming the unfinished harvest ending {}.".format(args.end))
+        else:
+            args.end = date.today().isoformat()
+    manifest.begun(args.query, args.start, args.end)
     #query = "OG=(Technical University of Denmark)"
     q = prep_qstring(args.query, count=100, start=args.start, end=args.end)
     logger.info("Fetching publications from WoS")
     logger.info("WOS query: {}".format(q))
     user = os.environ['WOS_USER']
     password = os.environ['WOS_PASSWORD']
-    # Authenticate if no session ID is passed in.
-    sid = args.session
-    if sid is None:
-        wos = wose.Session(user=user, password=password)
-        sid = wos.authenticate()
-        logger.info("Session ID: {}.".format(sid))
-    qid, num, records = wose.raw_query(q, sid, get_all=True)
-    logger.info("{} records found.".format(len(records)))
-    # Make output dir
-    outd = make_out_dir(args.out)
-    for rec in records:
-        ut = rec.find('./UID').text
-        path = get_path(ut, base_path=outd)
-        with open(path, 'w') as outfile:
-            outfile.write(ET.tostring(rec))
-
-
+    # Authenticate later if no session ID is passed in.
+    wos = wose.Session(user=user, password=password, sid=args.session)
+    store = None
+    if args.store is True:
+        store = SegmentStore(outd)
+    try:
+        if args.windows is True:
+            fetch_windows(args.query, args.start, args.end, outd, wos, store=store, restart=args.restart,
+                          sessions=args.sessions, manifest=manifest, incremental=args.incremental)
+        else:
+            fetch_query(q, outd, wos, store=store, restart=args.restart, manifest=manifest,
+                        incremental=args.incremental)
+        manifest.harvested(args.query, args.end)
+    finally:
+        if store is not None:
+            store.close()
+        manifest.close()
@@ -4,27 +4,333 @@ Helper code for connecting to VIVO's SPARQL Update API.
 
 
 import os
+import functools
 import hashlib
-
-from rdflib import Graph, URIRef
+import httplib
+import itertools
+import Queue
+import socket
+import tempfile
+import threading
+import time
+import types
+from multiprocessing.pool import ThreadPool
+
+from rdflib import Graph, Literal, URIRef
 from rdflib.query import ResultException
-from rdflib.compare import graph_diff
+from SPARQLWrapper.SPARQLExceptions import EndPointInternalError
 
 from vstore import VIVOUpdateStore
 
 from namespaces import ns_mgr
+from settings import SNAPSHOT_PATH, JOURNAL_PATH
+from lib.graphdiff import ADD, diff_graphs, diff_nt_files, read_nt_lines, sorted_lines, write_nt
+from lib.journal import BatchJournal, file_hash, lines_hash, load_key
+from lib.ntriples import nt_line
+from lib.snapshots import GraphSnapshots
 
 import logging
 logger = logging.getLogger('backend')
 
 BATCH_SIZE=8000
 
+# Subjects per CONSTRUCT when fetching existing triples for subjects.
+SUBJECT_BATCH_SIZE = 200
+# Concurrent CONSTRUCT queries when fetching existing triples for subjects.
+FETCH_THREADS = 4
+# Keys per page for the paginated cursor queries.
+PAGE_SIZE = 2000
+# Named graphs with more triples than this are read in hash buckets
+# rather than pages of subjects, which cost quadratic time on the server.
+KEYSET_MAX_TRIPLES = 200000
+# Triples aimed for in each hash bucket. Graphs are read in 16 buckets,
+# or 256 when they hold more than 16 times this.
+BUCKET_TRIPLES = 250000
+# Open stores kept per process. Threads wait when all are in use.
+STORE_POOL_SIZE = int(os.environ.get('VIVO_POOL_SIZE', 4))
+
+# Limits for the adaptive update batch size. See BatchController.
+MIN_BATCH_SIZE = 250
+MAX_BATCH_SIZE = 25000
+# Updates slower than this many seconds shrink the batch size.
+TARGET_SECONDS = 10.0
+# Longest pause between updates, in seconds.
+MAX_PAUSE = 60.0
+# Failed attempts at a batch before giving up.
+MAX_RETRIES = 6
+# Words in a 403 response that mark it as VIVO shedding load rather
+# than refusing access.
+OVERLOAD_HINTS = ("overload", "too many", "busy", "try again", "unavailable")
+# Journaled loads not touched for this many seconds are forgotten.
+JOURNAL_MAX_AGE = 7 * 24 * 60 * 60
+
+# Snapshots older than this many seconds aren't trusted on a count
+# check alone.
+SNAPSHOT_MAX_AGE = 7 * 24 * 60 * 60
+
+# Load strategies, cheapest first when costs tie. See SyncVStore.plan_load.
+BLIND_INSERT = "blind insert"
+SUBJECT_DIFF = "subject diff"
+FULL_DIFF = "full diff"
+STRATEGIES = (BLIND_INSERT, SUBJECT_DIFF, FULL_DIFF)
+# Estimated cost of a request, in triples transferred.
+REQUEST_COST = 1000
+# Estimated cost of reading a triple from a local snapshot, relative to
+# transferring one.
+SNAPSHOT_READ_COST = 0.05
+
+
+class LoadPlan(object):
+    """
+    The strategy chosen for loading into a named graph, with the
+    statistics it was chosen from.
+    """
+
+    def __init__(self, named_graph, strategy, existing, snapshot, costs):
+        self.named_graph = named_graph
+        self.strategy = strategy
+        # Triples in the graph when planned.
+        self.existing = existing
+        # Whether the local snapshot matches the graph.
+        self.snapshot = snapshot
+        # Estimated cost of each possible strategy, in triples
+        # transferred.
+        self.costs = costs
+
+
+class BatchController(object):
+    """
+    Sizes and paces SPARQL Update batches from how VIVO responds.
+
+    Batches grow by a fixed step while updates finish within
+    TARGET_SECONDS. A failed update halves the batch and doubles the
+    pause between updates. A slow one shrinks the batch in proportion
+    to how slow it was and pauses for the overrun. The pause halves
+    again while VIVO keeps up.
+    """
+
+    def __init__(self, size=BATCH_SIZE, min_size=MIN_BATCH_SIZE, max_size=MAX_BATCH_SIZE,
+                 target=TARGET_SECONDS, max_pause=MAX_PAUSE):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = max(min_size, min(size, max_size))
+        self.target = target
+        self.max_pause = max_pause
+        self.pause = 0.0
+        self._lock = threading.Lock()
+
+    def _resize(self, size):
+        size = max(self.min_size, min(int(size), self.max_size))
+        if size < self.size:
+            logger.info("Update batch size {} -> {}.".format(self.size, size))
+        self.size = size
+
+    def seed(self, size):
+        """
+        Start from a known good batch size.
+        """
+        with self._lock:
+            self._resize(size)
+
+    def succeeded(self, seconds):
+        with self._lock:
+            if seconds > self.target:
+                self._resize(self.size * self.target / seconds)
+                self.pause = min(self.max_pause, seconds - self.target)
+            else:
+                self._resize(self.size + self.min_size)
+                self.pause = self.pause / 2 if self.pause >= 0.5 else 0.0
+
+    def failed(self):
+        with self._lock:
+            self._resize(self.size / 2)
+            self.pause = min(self.max_pause, max(1.0, self.pause * 2))
+
+    def wait(self):
+        if self.pause > 0:
+            time.sleep(self.pause)
+
+
+def error_body(error):
+    """
+    Text of the response behind an HTTP error, or the error message.
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        return getattr(response, "text", None) or ""
+    if hasattr(error, "read"):
+        try:
+            return error.read() or ""
+        except Exception:
+            pass
+    return str(error)
+
+
+def is_transient(error):
+    """
+    True for update errors worth retrying: dropped connections, server
+    errors, 408 and 429, and a 403 whose body says VIVO is overloaded.
+    Other 403s are bad credentials or missing permissions and fail
+    straight away.
+    """
+    code = getattr(error, "code", None)
+    if code is None:
+        code = getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(code, int):
+        if code == 403:
+            body = error_body(error).lower()
+            return any(hint in body for hint in OVERLOAD_HINTS)
+        return (code in (408, 429)) or (code >= 500)
+    return isinstance(error, (IOError, socket.error, httplib.HTTPException, EndPointInternalError))
+
+
+_controller = None
+_controller_lock = threading.Lock()
+_journals = {}
+
+
+def get_controller():
+    """
+    The batch controller shared by all stores in the process, since
+    they load the same server.
+    """
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = BatchController()
+        return _controller
+
+
+def get_journal():
+    """
+    The batch journal, opened once per process.
+    """
+    pid = os.getpid()
+    with _controller_lock:
+        if pid not in _journals:
+            _journals[pid] = BatchJournal(JOURNAL_PATH)
+            removed = _journals[pid].prune(JOURNAL_MAX_AGE)
+            if removed > 0:
+                logger.info("Pruned {} old batch journal entries.".format(removed))
+        return _journals[pid]
+
+
+def bucket_digits(count):
+    """
+    Hex digits of the hash buckets used to read a graph of count
+    triples with bucket_construct.
+    """
+    return 1 if count <= 16 * BUCKET_TRIPLES else 2
+
+
+def nt_text(lines):
+    """
+    Join N-Triples lines into unicode. Lines read from files are UTF-8
+    byte strings, which may hold non-ASCII characters.
+    """
+    return u"".join(line.decode('utf-8') if isinstance(line, str) else line for line in lines)
+
 
 class SyncVStore(VIVOUpdateStore):
     """
     Extending VIVOUpdateStore with utilities
     for syncing data to named graphs.
+
+    Syncs keep a local snapshot of each named graph they write so the
+    next sync can skip downloading the graph when its triple count
+    hasn't changed. Adds and removes outside a sync drop the snapshot.
     """
+    snapshot_path = SNAPSHOT_PATH
+    _snapshots = None
+
+    @property
+    def snapshots(self):
+        if self._snapshots is None:
+            self._snapshots = GraphSnapshots(self.snapshot_path)
+        return self._snapshots
+
+    def post_batches(self, named_graph, lines, add=True, journal_key=None):
+        """
+        INSERT or DELETE N-Triples lines in a named graph in batches
+        sized and paced by the process's BatchController. A batch that
+        fails with a transient error is retried at the reduced size,
+        with the pause between attempts doubling each time. Returns the
+        number of lines posted.
+
+        With a journal_key, completed batches are journaled and a rerun
+        with the same key and lines skips what was already posted. The
+        lines must come in the same order each time.
+        """
+        controller = get_controller()
+        self.snapshots.drop(named_graph)
+        op = "INSERT" if add is True else "DELETE"
+        ng = URIRef(named_graph).n3()
+        lines = iter(lines)
+        position = 0
+        if journal_key is not None:
+            journal = get_journal()
+            journal.supersede(journal_key)
+            position = journal.resume_offset(journal_key)
+            if position > 0:
+                logger.info("Resuming {} of {} after {} posted triples.".format(op, named_graph, position))
+                for line in itertools.islice(lines, position):
+                    pass
+        pending = []
+        total = 0
+        failures = 0
+        while True:
+            size = controller.size
+            if len(pending) < size:
+                pending += itertools.islice(lines, size - len(pending))
+            if len(pending) == 0:
+                break
+            batch = pending[:size]
+            started = time.time()
+            try:
+                self.update(u"{} DATA {{ GRAPH {} {{\n{}}} }}".format(op, ng, nt_text(batch)))
+            except Exception as e:
+                failures += 1
+                if (is_transient(e) is False) or (failures >= MAX_RETRIES):
+                    raise
+                logger.warning("{} of {} triples in {} failed: {}".format(op, len(batch), named_graph, e))
+                controller.failed()
+                controller.wait()
+                continue
+            failures = 0
+            controller.succeeded(time.time() - started)
+            if journal_key is not None:
+                journal.record(journal_key, position, len(batch))
+            del pending[:len(batch)]
+            position += len(batch)
+            total += len(batch)
+            controller.wait()
+        if journal_key is not None:
+            journal.finish(journal_key)
+        return total
+
+    def _post_graph(self, named_graph, graph, add, resumable):
+        if resumable is not True:
+            return self.post_batches(named_graph, (nt_line(t) for t in graph), add=add)
+        # Graph order isn't stable between runs, so sort to make
+        # journaled offsets meaningful.
+        lines = sorted(nt_line(t) for t in graph)
+        key = load_key(lines_hash(lines), named_graph, "add" if add is True else "remove")
+        return self.post_batches(named_graph, lines, add=add, journal_key=key)
+
+    def bulk_add(self, named_graph, graph, size=None, resumable=False):
+        """
+        Add triples to a named graph. Batch sizes are adaptive, so
+        size is ignored. A resumable add picks up where a failed add
+        of the same triples stopped.
+        """
+        return self._post_graph(named_graph, graph, True, resumable)
+
+    def bulk_remove(self, named_graph, graph, size=None, resumable=False):
+        """
+        Remove triples from a named graph. Batch sizes are adaptive,
+        so size is ignored.
+        """
+        return self._post_graph(named_graph, graph, False, resumable)
 
     def ng_construct(self, named_graph, rq):
         """
@@ -41,53 +347,299 @@ class SyncVStore(VIVOUpdateStore):
         except ResultException:
             return Graph()
 
-    def get_existing(self, named_graph):
+    def page_keys(self, where, key, size=PAGE_SIZE, prefixes=""):
+        """
+        Yield pages of the distinct values of ?key matching the where
+        pattern. Pages are ordered by key and each query starts after
+        the last key of the previous page rather than at an OFFSET.
+
+        STR(?key) isn't indexed, so the store still matches and sorts
+        every key past the filter for each page: reading n keys costs
+        about n * n / size on the server. Use it for small result sets;
+        iter_existing reads large graphs with bucket_construct instead.
+        """
+        last = None
+        while True:
+            if last is None:
+                after = ""
+            else:
+                after = "FILTER (STR(?{}) > {})".format(key, Literal(last).n3())
+            rq = prefixes + """
+            SELECT DISTINCT ?{key}
+            WHERE {{
+                {where}
+                {after}
+            }}
+            ORDER BY STR(?{key})
+            LIMIT {size}
+            """.format(key=key, where=where, after=after, size=size)
+            keys = [row[0] for row in self.query(rq)]
+            if len(keys) > 0:
+                yield keys
+            if len(keys) < size:
+                break
+            last = unicode(keys[-1])
+
+    def _values(self, key, keys):
+        return "VALUES ?{} {{ {} }}".format(key, " ".join(k.n3() for k in keys))
+
+    def cursor_select(self, variables, where, key, size=PAGE_SIZE, prefixes=""):
+        """
+        Run a SELECT a page of keys at a time, yielding rows. All of
+        the rows for a key come from the same page.
+        """
+        for keys in self.page_keys(where, key, size=size, prefixes=prefixes):
+            rq = prefixes + """
+            SELECT {variables}
+            WHERE {{
+                {values}
+                {where}
+            }}
+            """.format(variables=variables, values=self._values(key, keys), where=where)
+            for row in self.query(rq):
+                yield row
+
+    def cursor_construct(self, template, where, key, size=PAGE_SIZE, prefixes=""):
+        """
+        Run a CONSTRUCT a page of keys at a time, yielding triples.
+        """
+        for keys in self.page_keys(where, key, size=size, prefixes=prefixes):
+            rq = prefixes + """
+            CONSTRUCT {{ {template} }}
+            WHERE {{
+                {values}
+                {where}
+            }}
+            """.format(template=template, values=self._values(key, keys), where=where)
+            try:
+                g = self.query(rq).graph
+            except ResultException:
+                continue
+            for triple in g:
+                yield triple
+
+    def bucket_construct(self, template, where, key, digits=1, prefixes=""):
+        """
+        Run a CONSTRUCT once per bucket of keys, yielding triples. Keys
+        are bucketed by the leading hex digits of the MD5 of their
+        string value, so buckets are even whatever the keys look like.
+        Each of the 16 ** digits buckets is a scan of the where pattern
+        without sorting, so the server's work grows with the number of
+        buckets times n rather than with n * n.
+        """
+        for num in range(16 ** digits):
+            rq = prefixes + """
+            CONSTRUCT {{ {template} }}
+            WHERE {{
+                {where}
+                FILTER (STRSTARTS(MD5(STR(?{key})), "{bucket}"))
+            }}
+            """.format(template=template, where=where, key=key, bucket="{:0{}x}".format(num, digits))
+            try:
+                g = self.query(rq).graph
+            except ResultException:
+                continue
+            for triple in g:
+                yield triple
+
+    def iter_existing(self, named_graph, size=PAGE_SIZE, count=None):
+        """
+        Yield existing triples from a named graph, a page of subjects
+        at a time, or a hash bucket of subjects at a time for graphs
+        of more than KEYSET_MAX_TRIPLES. count is the graph's triple
+        count, when known.
+        """
+        where = "GRAPH {} {{ ?s ?p ?o }}".format(URIRef(named_graph).n3())
+        if count is None:
+            count = self.count_triples(named_graph)
+        if count <= KEYSET_MAX_TRIPLES:
+            return self.cursor_construct("?s ?p ?o", where, "s", size=size)
+        digits = bucket_digits(count)
+        logger.info("Reading {} triples from {} in {} hash buckets.".format(count, named_graph, 16 ** digits))
+        return self.bucket_construct("?s ?p ?o", where, "s", digits=digits)
+
+    def get_existing(self, named_graph, count=None):
         """
         Get existing triples from a named graph.
         """
-        # SPARQL query to fetch existing data.
-        rq = """
-        CONSTRUCT {?s ?p ?o }
-        WHERE { GRAPH ?g {?s ?p ?o } }
+        g = Graph()
+        for triple in self.iter_existing(named_graph, count=count):
+            g.add(triple)
+        return g
+
+    def get_subjects(self, named_graph, subjects):
         """
+        Get existing triples for the given subjects from a named graph.
+        """
+        rq = """
+        CONSTRUCT {{ ?s ?p ?o }}
+        WHERE {{
+            VALUES ?s {{ {} }}
+            GRAPH ?g {{ ?s ?p ?o }}
+        }}
+        """.format(" ".join(URIRef(subject).n3() for subject in subjects))
         return self.ng_construct(named_graph, rq)
 
+    def count_triples(self, named_graph):
+        """
+        Number of triples in a named graph.
+        """
+        # The graph goes in the query text. A VALUES binding would be
+        # joined after the aggregate.
+        rq = """
+        SELECT (COUNT(*) AS ?n)
+        WHERE {{ GRAPH {} {{ ?s ?p ?o }} }}
+        """.format(URIRef(named_graph).n3())
+        for row in self.query(rq):
+            return int(row[0])
+        return 0
+
+    def has_current_snapshot(self, named_graph, current=None):
+        """
+        Check the local snapshot of a named graph against the server's
+        triple count, which can be passed in as current if known.
+        """
+        count = self.snapshots.count(named_graph)
+        if count is None:
+            return False
+        if self.snapshots.age(named_graph) > SNAPSHOT_MAX_AGE:
+            logger.info("Snapshot of {} is too old to trust.".format(named_graph))
+            return False
+        if current is None:
+            current = self.count_triples(named_graph)
+        if current != count:
+            logger.info("Snapshot of {} has {} triples, server has {}.".format(named_graph, count, current))
+            return False
+        return True
+
+    def get_existing_cached(self, named_graph, current=None):
+        """
+        Existing triples in a named graph, from the local snapshot when
+        it's current. Otherwise they're downloaded and snapshotted.
+        """
+        if self.has_current_snapshot(named_graph, current=current):
+            logger.info("Using local snapshot of {}.".format(named_graph))
+            g = Graph()
+            g.parse(self.snapshots.nt_path(named_graph), format="nt")
+            return g
+        existing = self.get_existing(named_graph, count=current)
+        self.snapshots.save(named_graph, existing)
+        return existing
+
+    def plan_load(self, named_graph, incoming=None, subjects=None, sync=True):
+        """
+        Pick the cheapest correct way to load into a named graph from
+        its triple count and local snapshot.
+
+        With sync the graph has to end up holding just the incoming
+        triples. Otherwise the incoming triples replace those of their
+        subjects, which a subject diff can do given the subjects.
+        incoming is the number of incoming triples, when known.
+        """
+        existing = self.count_triples(named_graph)
+        snapshot = self.has_current_snapshot(named_graph, current=existing)
+        costs = {}
+        if existing == 0:
+            costs[BLIND_INSERT] = 0
+        if snapshot is True:
+            costs[FULL_DIFF] = int(existing * SNAPSHOT_READ_COST)
+        elif existing > KEYSET_MAX_TRIPLES:
+            # A query per hash bucket.
+            costs[FULL_DIFF] = existing + REQUEST_COST * 16 ** bucket_digits(existing)
+        else:
+            # A page of keys and a page of triples per PAGE_SIZE keys.
+            costs[FULL_DIFF] = existing + REQUEST_COST * 2 * (existing // PAGE_SIZE + 1)
+        if (sync is not True) and (subjects is not None):
+            fetched = existing if incoming is None else min(existing, incoming)
+            costs[SUBJECT_DIFF] = fetched + REQUEST_COST * (len(subjects) // SUBJECT_BATCH_SIZE + 1)
+        strategy = min(costs, key=lambda name: (costs[name], STRATEGIES.index(name)))
+        logger.info("Load plan for {} with {} existing triples: {}. Estimated costs: {}.".format(
+            named_graph,
+            existing,
+            strategy,
+            ", ".join("{} {}".format(name, costs[name]) for name in STRATEGIES if name in costs)
+        ))
+        return LoadPlan(named_graph, strategy, existing, snapshot, costs)
+
     def sync_named_graph(self, name, incoming, size=BATCH_SIZE):
         """
         Pass in incoming data and sync with existing data in
         named graph.
         """
-        existing = self.get_existing(name)
-        both, adds, deletes = graph_diff(incoming, existing)
-        del both
+        plan = self.plan_load(name, incoming=len(incoming))
+        if plan.strategy == BLIND_INSERT:
+            existing = Graph()
+        else:
+            existing = self.get_existing_cached(name, current=plan.existing)
+        adds, deletes = diff_graphs(incoming, existing)
         added = self.bulk_add(name, adds, size=size)
         logger.info("Adding {} triples to {}.".format(added, name))
         removed = self.bulk_remove(name, deletes, size=size)
         logger.info("Removed {} triples from {}.".format(removed, name))
+        self.snapshots.save(name, incoming)
         return added, removed
 
 
-def post_updates(named_graph, graph, delay=20):
+def get_existing_subjects(named_graph, subjects, size=SUBJECT_BATCH_SIZE, threads=FETCH_THREADS):
     """
-    Function for posting the data.
+    Get existing triples for subjects from a named graph, with batches
+    of size subjects per query and up to threads queries at once.
     """
+    subjects = sorted(set(subjects))
+    batches = [subjects[i:i + size] for i in range(0, len(subjects), size)]
+    existing = Graph()
+    if len(batches) == 0:
+        return existing
     vstore = get_store()
 
-    existing = vstore.get_existing(named_graph)
+    def fetch(batch):
+        return vstore.get_subjects(named_graph, batch)
+
+    if threads <= 1:
+        results = (fetch(batch) for batch in batches)
+        pool = None
+    else:
+        pool = ThreadPool(min(threads, len(batches)))
+        results = pool.imap_unordered(fetch, batches)
+    try:
+        for g in results:
+            existing += g
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    logger.info("Fetched {} existing triples for {} subjects in {}.".format(len(existing), len(subjects), named_graph))
+    return existing
+
+
+def post_updates(named_graph, graph, delay=20, size=SUBJECT_BATCH_SIZE, threads=FETCH_THREADS):
+    """
+    Function for posting the data.
+    """
+    vstore = get_store()
 
     # Get the URIs for statements that will be additions.
     changed_uris = set([u for u in graph.subjects()])
 
+    plan = vstore.plan_load(named_graph, incoming=len(graph), subjects=changed_uris, sync=False)
+
     # Get the statements from the deletes that apply to this
     # incremental update. This will be the posted deletes.
-    remove_graph = Graph()
-    # Remove all triples related to the changed uris.
-    for curi in changed_uris:
-        for pred, obj in existing.predicate_objects(subject=curi):
-            remove_graph.add((curi, pred, obj))
+    if plan.strategy == BLIND_INSERT:
+        remove_graph = Graph()
+    elif plan.strategy == SUBJECT_DIFF:
+        # Only triples for the changed uris are fetched.
+        remove_graph = get_existing_subjects(named_graph, changed_uris, size=size, threads=threads)
+    else:
+        existing = vstore.get_existing_cached(named_graph, current=plan.existing)
+        remove_graph = Graph()
+        # Remove all triples related to the changed uris.
+        for curi in changed_uris:
+            for pred, obj in existing.predicate_objects(subject=curi):
+                remove_graph.add((curi, pred, obj))
 
     # Diff
-    both, adds, deletes = graph_diff(graph, remove_graph)
+    adds, deletes = diff_graphs(graph, remove_graph)
 
     num_additions = len(adds)
     num_remove = len(deletes)
@@ -116,7 +668,278 @@ def sync_updates(named_graph, graph, size=BATCH_SIZE):
     return add, remove
 
 
+def _mkstemp():
+    fd, path = tempfile.mkstemp(suffix=".nt")
+    os.close(fd)
+    return path
+
+
+class PreparedLoad(object):
+    """
+    N-Triples lines to add to and delete from a named graph, worked out
+    ahead of posting. Posting only sends lines, so the next load can be
+    prepared while this one is posted.
+    """
+
+    def __init__(self, named_graph):
+        self.named_graph = named_graph
+        self.adds_path = None
+        self.deletes_path = None
+        # Line counts, when known.
+        self.num_adds = None
+        self.num_deletes = None
+        self.journal_key = None
+        # N-Triples file of what the graph holds once posted, saved as
+        # its snapshot.
+        self.snapshot_source = None
+        self._tmp_paths = []
+
+    def tmp_path(self):
+        path = _mkstemp()
+        self._tmp_paths.append(path)
+        return path
+
+    def post(self):
+        vstore = get_store()
+        added = 0
+        removed = 0
+        if self.adds_path is not None:
+            added = vstore.post_batches(self.named_graph, read_nt_lines(self.adds_path), journal_key=self.journal_key)
+            logger.info("Added {} triples to {}.".format(added, self.named_graph))
+        if self.deletes_path is not None:
+            removed = vstore.post_batches(self.named_graph, read_nt_lines(self.deletes_path), add=False)
+            logger.info("Removed {} triples from {}.".format(removed, self.named_graph))
+        if self.snapshot_source is not None:
+            vstore.snapshots.save_lines(self.named_graph, sorted_lines(read_nt_lines(self.snapshot_source)))
+        return added, removed
+
+    def close(self):
+        for path in self._tmp_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self._tmp_paths = []
+
+
+def prepare_nt_add(named_graph, path, resumable=True):
+    """
+    Add the lines of an N-Triples file as they are, without parsing.
+    A resumable load is journaled under the file's content hash.
+    """
+    load = PreparedLoad(named_graph)
+    load.adds_path = path
+    if resumable is True:
+        load.journal_key = load_key(file_hash(path), named_graph, "add")
+    return load
+
+
+def prepare_nt_sync(named_graph, path):
+    """
+    Diff an N-Triples file written by nt_line against a named graph.
+    The diff runs on disk, so the file is never loaded as a graph.
+    """
+    load = PreparedLoad(named_graph)
+    vstore = get_store()
+    plan = vstore.plan_load(named_graph)
+    if plan.strategy == BLIND_INSERT:
+        # Nothing to diff against.
+        load.adds_path = path
+        load.snapshot_source = path
+        return load
+    try:
+        if plan.snapshot is True:
+            logger.info("Using local snapshot of {}.".format(named_graph))
+            existing_path = vstore.snapshots.nt_path(named_graph)
+        else:
+            existing_path = load.tmp_path()
+            write_nt(vstore.iter_existing(named_graph, count=plan.existing), existing_path)
+        load.adds_path = load.tmp_path()
+        load.deletes_path = load.tmp_path()
+        load.num_adds = 0
+        load.num_deletes = 0
+        with open(load.adds_path, 'w') as adds_file, open(load.deletes_path, 'w') as deletes_file:
+            for op, line in diff_nt_files(path, existing_path):
+                if op == ADD:
+                    adds_file.write(line)
+                    load.num_adds += 1
+                else:
+                    deletes_file.write(line)
+                    load.num_deletes += 1
+        load.snapshot_source = path
+    except Exception:
+        load.close()
+        raise
+    return load
+
+
+def prepare_graph(named_graph, graph, sync=False):
+    """
+    Prepare a graph for posting. A sync diffs it against the named
+    graph. Otherwise it's added, journaled under its sorted lines so a
+    failed load can resume.
+    """
+    load = PreparedLoad(named_graph)
+    try:
+        load.adds_path = load.tmp_path()
+        if sync is True:
+            vstore = get_store()
+            plan = vstore.plan_load(named_graph, incoming=len(graph))
+            if plan.strategy == BLIND_INSERT:
+                existing = Graph()
+            else:
+                existing = vstore.get_existing_cached(named_graph, current=plan.existing)
+            adds, deletes = diff_graphs(graph, existing)
+            load.num_adds = write_nt(adds, load.adds_path)
+            load.deletes_path = load.tmp_path()
+            load.num_deletes = write_nt(deletes, load.deletes_path)
+            load.snapshot_source = load.tmp_path()
+            write_nt(graph, load.snapshot_source)
+        else:
+            lines = sorted(nt_line(t) for t in graph)
+            with open(load.adds_path, 'w') as out_file:
+                out_file.writelines(lines)
+            load.num_adds = len(lines)
+            load.journal_key = load_key(lines_hash(lines), named_graph, "add")
+    except Exception:
+        load.close()
+        raise
+    return load
+
+
+def post_prepared(load):
+    try:
+        return load.post()
+    finally:
+        load.close()
+
+
+def post_nt_file(named_graph, path, resumable=True):
+    """
+    Add the triples in an N-Triples file to a named graph. Lines are
+    sent as they are read, so memory use doesn't grow with the file.
+    """
+    logger.info("Posting {} to {}.".format(path, named_graph))
+    added, removed = post_prepared(prepare_nt_add(named_graph, path, resumable=resumable))
+    return added
+
+
+def sync_file_updates(named_graph, path, size=BATCH_SIZE):
+    """
+    Sync a named graph with an N-Triples file.
+    """
+    logger.info("Syncing {} from {}.".format(named_graph, path))
+    return post_prepared(prepare_nt_sync(named_graph, path))
+
+
+class StorePool(object):
+    """
+    A fixed number of open stores shared by the threads of a process.
+
+    Calling a store method on the pool borrows a free store for the
+    call, or until the generator it returns is exhausted. A thread that
+    already holds a store reuses it, so iterating a cursor and querying
+    inside the loop doesn't take a second store. The holder and depth
+    are kept with the store, so a generator finished on another thread
+    still gives its store back.
+    """
+
+    def __init__(self, factory, size=STORE_POOL_SIZE):
+        self.factory = factory
+        self.size = size
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        # Every store made, for reading plain attributes.
+        self._stores = []
+        # id(store) -> [holding thread, depth, store] for stores in use.
+        self._held = {}
+
+    def acquire(self):
+        me = threading.current_thread().ident
+        with self._lock:
+            for entry in self._held.values():
+                if entry[0] == me:
+                    entry[1] += 1
+                    return entry[2]
+        self._slots.acquire()
+        try:
+            vstore = self._idle.get_nowait()
+        except Queue.Empty:
+            try:
+                vstore = self.factory()
+            except Exception:
+                self._slots.release()
+                raise
+            with self._lock:
+                self._stores.append(vstore)
+        with self._lock:
+            self._held[id(vstore)] = [me, 1, vstore]
+        return vstore
+
+    def release(self, vstore):
+        with self._lock:
+            entry = self._held[id(vstore)]
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self._held[id(vstore)]
+        self._idle.put(vstore)
+        self._slots.release()
+
+    def _hold(self, vstore, results):
+        try:
+            for item in results:
+                yield item
+        finally:
+            self.release(vstore)
+
+    def _call(self, name, *args, **kwargs):
+        vstore = self.acquire()
+        try:
+            result = getattr(vstore, name)(*args, **kwargs)
+        except Exception:
+            self.release(vstore)
+            raise
+        if isinstance(result, types.GeneratorType):
+            return self._hold(vstore, result)
+        self.release(vstore)
+        return result
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if callable(getattr(SyncVStore, name, None)):
+            return functools.partial(self._call, name)
+        # Plain attributes are the same on every store, so read one
+        # without taking a slot.
+        with self._lock:
+            stores = list(self._stores)
+        if stores:
+            return getattr(stores[0], name)
+        vstore = self.acquire()
+        try:
+            return getattr(vstore, name)
+        finally:
+            self.release(vstore)
+
+
+_store_pools = {}
+_store_pools_lock = threading.Lock()
+
+
 def get_store():
+    """
+    The process-wide pool of VIVO stores. It has the same methods as
+    SyncVStore and is safe to use from threads.
+    """
+    # Forked processes get their own connections.
+    pid = os.getpid()
+    with _store_pools_lock:
+        if pid not in _store_pools:
+            _store_pools[pid] = StorePool(connect_store)
+        return _store_pools[pid]
+
+
+def connect_store():
     """
     Connect to the raw store.
     """
@@ -130,6 +953,8 @@ def get_store():
             )
     vstore.open((query_endpoint, update_endpoint))
     vstore.namespace_manager = ns_mgr
+    # Reuse HTTP connections between requests on this store.
+    vstore.setUseKeepAlive()
     return vstore
 
 
@@ -0,0 +1,164 @@
+"""
+Diffs for graphs without blank nodes.
+
+rdflib.compare.graph_diff canonicalizes both graphs so blank nodes can
+be matched up, which is slow on large graphs. The mappings here only
+produce URIs and literals, so plain set operations give the same adds
+and deletes. For files larger than memory, N-Triples lines are sorted
+on disk and merged.
+"""
+
+import heapq
+import itertools
+import os
+import tempfile
+
+from rdflib import BNode, Graph
+from rdflib.compare import graph_diff
+
+from lib.ntriples import nt_line
+
+# Lines sorted in memory at a time when sorting on disk.
+SORT_CHUNK_SIZE = 500000
+
+ADD = "+"
+DELETE = "-"
+
+
+def is_ground(graph):
+    """
+    True if no triple in the graph has a blank node.
+    """
+    for triple in graph:
+        for term in triple:
+            if isinstance(term, BNode):
+                return False
+    return True
+
+
+def to_graph(triples):
+    g = Graph()
+    for triple in triples:
+        g.add(triple)
+    return g
+
+
+def ground_diff(incoming, existing):
+    """
+    Triples to add and delete to make existing match incoming, as
+    graphs.
+    """
+    incoming = set(incoming)
+    existing = set(existing)
+    return to_graph(incoming - existing), to_graph(existing - incoming)
+
+
+def diff_graphs(incoming, existing):
+    """
+    Adds and deletes to make existing match incoming. Falls back to
+    graph_diff when either graph has blank nodes.
+    """
+    if is_ground(incoming) and is_ground(existing):
+        return ground_diff(incoming, existing)
+    both, adds, deletes = graph_diff(incoming, existing)
+    return adds, deletes
+
+
+def _write_run(lines):
+    fd, path = tempfile.mkstemp(suffix=".nt")
+    with os.fdopen(fd, 'w') as out_file:
+        out_file.writelines(lines)
+    return path
+
+
+def sorted_lines(lines, chunk_size=SORT_CHUNK_SIZE):
+    """
+    Yield the distinct lines in sorted order. Input longer than
+    chunk_size lines is sorted in runs written to temporary files,
+    which are then merged.
+    """
+    run_paths = []
+    try:
+        lines = iter(lines)
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            # Check the count before removing duplicates; a short chunk
+            # means the input has run out.
+            exhausted = len(chunk) < chunk_size
+            chunk = sorted(set(chunk))
+            if not run_paths and exhausted:
+                # Fits in memory.
+                for line in chunk:
+                    yield line
+                return
+            if chunk:
+                run_paths.append(_write_run(chunk))
+            del chunk
+            if exhausted:
+                break
+        run_files = [open(path) for path in run_paths]
+        try:
+            last = None
+            for line in heapq.merge(*run_files):
+                if line != last:
+                    yield line
+                    last = line
+        finally:
+            for run_file in run_files:
+                run_file.close()
+    finally:
+        for path in run_paths:
+            os.remove(path)
+
+
+def merge_diff(incoming, existing):
+    """
+    Walk two sorted iterables of distinct lines together, yielding
+    (ADD, line) for lines only in incoming and (DELETE, line) for lines
+    only in existing.
+    """
+    incoming = iter(incoming)
+    existing = iter(existing)
+    new = next(incoming, None)
+    old = next(existing, None)
+    while (new is not None) or (old is not None):
+        if (old is None) or ((new is not None) and (new < old)):
+            yield ADD, new
+            new = next(incoming, None)
+        elif (new is None) or (old < new):
+            yield DELETE, old
+            old = next(existing, None)
+        else:
+            new = next(incoming, None)
+            old = next(existing, None)
+
+
+def read_nt_lines(path):
+    with open(path) as inf:
+        for line in inf:
+            if line.strip():
+                yield line if line.endswith("\n") else line + "\n"
+
+
+def diff_nt_files(incoming_path, existing_path, chunk_size=SORT_CHUNK_SIZE):
+    """
+    Diff two N-Triples files without loading either into memory.
+    Lines are compared as text, so both files must be written the
+    same way, e.g. with nt_line or Graph.serialize(format='nt').
+    """
+    return merge_diff(
+        sorted_lines(read_nt_lines(incoming_path), chunk_size),
+        sorted_lines(read_nt_lines(existing_path), chunk_size)
+    )
+
+
+def write_nt(triples, path):
+    """
+    Write triples to an N-Triples file. Returns the number of lines.
+    """
+    num = 0
+    with open(path, 'w') as out_file:
+        for triple in triples:
+            out_file.write(nt_line(triple))
+            num += 1
+    return num
@@ -0,0 +1,489 @@
+"""
+Checkpointed WoS harvests.
+
+A checkpoint keeps the query, the session and query IDs WoS gave it, the
+last page written and the UTs written so far. A harvest that stops part
+way, because the session expired or the network dropped, picks up from
+the page after the last one written. When the query ID has gone stale
+the query is sent again and records already written are skipped by UT.
+If the query then finds a different number of records, pages may have
+shifted, so the harvest starts again from the first page.
+
+Long date ranges are planned as windows, calendar months split further
+where WoS finds more records than one query can retrieve. Windows are
+harvested in parallel, each with its own session, and records found by
+more than one window are written once.
+
+A manifest in the output directory keeps the content hash of every
+record written and when each query was last harvested in full, so an
+incremental harvest can ask only for records loaded since then and
+leave unchanged records alone.
+"""
+
+from datetime import datetime, timedelta
+import hashlib
+import itertools
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import Queue
+import sqlite3
+import threading
+import time
+
+import requests
+
+from lib import wose
+from lib.hashcache import content_hash
+
+import logging
+logger = logging.getLogger("wose-client")
+
+# Failures in a row, without a page written in between, before giving up.
+MAX_ATTEMPTS = 5
+# Seconds to wait before retrying after a network error or a fault that
+# isn't about the session or query ID, doubled each time.
+RETRY_PAUSE = 5
+
+# Start recorded for the page of records returned with the query.
+FIRST_PAGE = 1
+
+# Most records WoS retrieves for one query. Windows finding more are
+# split.
+MAX_WINDOW_RECORDS = 100000
+# Windows harvested at once, each with a session of its own.
+WINDOW_WORKERS = 3
+
+
+MANIFEST_NAME = ".harvest-manifest.db"
+
+
+def checkpoint_path(outd, query):
+    """
+    Checkpoint file for a query harvested into outd.
+    """
+    return os.path.join(outd, ".harvest-{}.json".format(hashlib.md5(query).hexdigest()))
+
+
+def _save_json(path, state):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as out_file:
+        json.dump(state, out_file)
+    os.rename(tmp_path, path)
+
+
+def _read_uts(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as inf:
+        return set(line.strip() for line in inf if line.strip())
+
+
+def _append_uts(path, uts):
+    with open(path, 'a') as out_file:
+        for ut in uts:
+            out_file.write(ut + "\n")
+
+
+def _remove(*paths):
+    for fpath in paths:
+        if os.path.exists(fpath):
+            os.remove(fpath)
+
+
+def get_ut(rec):
+    return rec.find('./UID').text
+
+
+class HarvestCheckpoint(object):
+
+    def __init__(self, path, query):
+        self.path = path
+        self.uts_path = os.path.splitext(path)[0] + ".uts"
+        self.query = query
+        self.sid = None
+        self.qid = None
+        self.num = None
+        self.last_start = 0
+        self.uts = set()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as inf:
+                state = json.load(inf)
+        except (IOError, ValueError):
+            return
+        if state.get('query') != self.query:
+            return
+        self.sid = state.get('sid')
+        self.qid = state.get('qid')
+        self.num = state.get('num')
+        self.last_start = state.get('last_start', 0)
+        self.uts = _read_uts(self.uts_path)
+
+    @property
+    def resuming(self):
+        return self.last_start > 0
+
+    def save(self):
+        _save_json(self.path, {
+            'query': self.query,
+            'sid': self.sid,
+            'qid': self.qid,
+            'num': self.num,
+            'last_start': self.last_start,
+        })
+
+    def started(self, sid, qid, num):
+        """
+        Record the query ID and hit count of a newly sent query.
+        """
+        self.sid = sid
+        self.qid = qid
+        self.num = num
+        self.save()
+
+    def set_sid(self, sid):
+        self.sid = sid
+        self.save()
+
+    def reset_query(self):
+        """
+        Forget the query ID so the query is sent again.
+        """
+        self.qid = None
+        self.save()
+
+    def restart(self):
+        """
+        Go back to the first page. UTs already written are kept.
+        """
+        self.last_start = 0
+
+    def page_done(self, start, uts):
+        """
+        Record a page as written. UTs go to disk before the page start,
+        so a page is never marked done with its UTs missing.
+        """
+        _append_uts(self.uts_path, uts)
+        self.uts.update(uts)
+        self.last_start = start
+        self.save()
+
+    def finish(self):
+        """
+        Remove the checkpoint once the harvest is complete.
+        """
+        _remove(self.path, self.uts_path)
+
+
+def _pages(q, session, checkpoint, count, workers):
+    """
+    Yield (start, recs) for the pages of a query after the last one
+    written, sending the query first if there's no query ID to reuse.
+    """
+    client = wose.Client(session.sid)
+    if checkpoint.qid is None:
+        logger.info("QUERY:\n" + q)
+        qid, num, records = client.query(q)
+        logger.info("Found {} records for search.".format(num))
+        if (checkpoint.num is not None) and (num != checkpoint.num):
+            # Records may have moved between pages. Start again; the
+            # ones already written are skipped by UT.
+            logger.warning("Query found {} records, {} when the harvest started. Starting from the first page.".format(
+                num, checkpoint.num))
+            checkpoint.restart()
+        checkpoint.started(session.sid, qid, num)
+        if not checkpoint.resuming:
+            yield FIRST_PAGE, wose.get_recs(records)
+    starts = [start for start in wose.get_pages(count, checkpoint.num) if start > checkpoint.last_start]
+    pages = wose.retrieve_pages(client, checkpoint.qid, starts, workers=workers)
+    for start, xml in itertools.izip(starts, pages):
+        yield start, wose.get_recs(xml) if xml else []
+
+
+def harvest(q, session, checkpoint, count=100, workers=wose.RETRIEVE_WORKERS):
+    """
+    Yield pages of records for a query that aren't already written,
+    each a list of REC elements. A page is marked done in the checkpoint
+    when the next one is asked for, so it has to be written before
+    then. On an expired session the session is authenticated again, on
+    a stale query ID the query is sent again, and other faults and
+    network errors are retried after a pause.
+    """
+    if checkpoint.resuming:
+        logger.info("Resuming harvest after record {}, {} records already written.".format(
+            checkpoint.last_start, len(checkpoint.uts)))
+    failures = 0
+    while True:
+        try:
+            for start, recs in _pages(q, session, checkpoint, count, workers):
+                uts = [get_ut(rec) for rec in recs]
+                new = [rec for rec, ut in zip(recs, uts) if ut not in checkpoint.uts]
+                if new:
+                    yield new
+                checkpoint.page_done(start, uts)
+                failures = 0
+            checkpoint.finish()
+            return
+        except (wose.WosFault, requests.exceptions.RequestException) as e:
+            failures += 1
+            if failures > MAX_ATTEMPTS:
+                raise
+            logger.warning("Harvest interrupted after record {}: {}".format(checkpoint.last_start, e))
+            if isinstance(e, wose.SessionException):
+                checkpoint.set_sid(session.authenticate())
+            elif isinstance(e, wose.QueryIdException):
+                checkpoint.reset_query()
+            else:
+                time.sleep(RETRY_PAUSE * 2 ** (failures - 1))
+
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def month_windows(start, end):
+    """
+    (begin, end) ISO dates for each calendar month from start to end,
+    clipped to both.
+    """
+    begin = parse_date(start)
+    last = parse_date(end)
+    while begin <= last:
+        next_month = (begin.replace(day=1) + timedelta(days=32)).replace(day=1)
+        yield begin.isoformat(), min(next_month - timedelta(days=1), last).isoformat()
+        begin = next_month
+
+
+def split_window(begin, end):
+    """
+    Split a window of ISO dates into two halves.
+    """
+    first = parse_date(begin)
+    last = parse_date(end)
+    mid = first + timedelta(days=(last - first).days // 2)
+    return [(first.isoformat(), mid.isoformat()), ((mid + timedelta(days=1)).isoformat(), last.isoformat())]
+
+
+def plan_windows(make_query, session, start, end, limit=MAX_WINDOW_RECORDS):
+    """
+    Windows covering start to end as [begin, end, records found] lists.
+    Windows start as calendar months and are split in half until they
+    find no more than limit records. Windows that find nothing are left
+    out. make_query(begin, end, count) builds the SOAP query for a
+    window.
+    """
+    client = wose.Client(session.sid)
+    windows = []
+    todo = list(month_windows(start, end))
+    while todo:
+        begin, end = todo.pop(0)
+        qid, num, records = client.query(make_query(begin, end, 1))
+        if (num > limit) and (begin != end):
+            todo[0:0] = split_window(begin, end)
+        elif num > 0:
+            if num > limit:
+                logger.warning("{} records found on {}, only {} can be retrieved.".format(num, begin, limit))
+            windows.append([begin, end, num])
+    return windows
+
+
+class HarvestPlan(object):
+    """
+    Windows of a harvest and which of them are done, with the UTs
+    written across all windows. Each window resumes from a checkpoint
+    of its own.
+    """
+
+    def __init__(self, outd, query, make_query, count=100):
+        self.outd = outd
+        self.query = query
+        self.make_query = make_query
+        self.count = count
+        base = os.path.join(outd, ".harvest-plan-{}".format(hashlib.md5(query).hexdigest()))
+        self.path = base + ".json"
+        self.uts_path = base + ".uts"
+        self.windows = None
+        self.done = set()
+        self.uts = set()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as inf:
+                state = json.load(inf)
+        except (IOError, ValueError):
+            return
+        if state.get('query') != self.query:
+            return
+        self.windows = state['windows']
+        self.done = set(tuple(window) for window in state['done'])
+        self.uts = _read_uts(self.uts_path)
+
+    def save(self):
+        _save_json(self.path, {
+            'query': self.query,
+            'windows': self.windows,
+            'done': sorted(self.done),
+        })
+
+    @property
+    def num(self):
+        return sum(num for begin, end, num in self.windows or [])
+
+    def window_query(self, begin, end):
+        return self.make_query(begin, end, self.count)
+
+    def checkpoint(self, begin, end):
+        q = self.window_query(begin, end)
+        return HarvestCheckpoint(checkpoint_path(self.outd, q), q)
+
+    def planned(self, windows):
+        self.windows = windows
+        self.save()
+
+    def pending(self):
+        return [window for window in self.windows if (window[0], window[1]) not in self.done]
+
+    def window_done(self, begin, end):
+        self.done.add((begin, end))
+        self.save()
+
+    def written(self, uts):
+        _append_uts(self.uts_path, uts)
+        self.uts.update(uts)
+
+    def finish(self):
+        """
+        Remove the plan and the checkpoints of its windows.
+        """
+        for begin, end, num in self.windows or []:
+            self.checkpoint(begin, end).finish()
+        _remove(self.path, self.uts_path)
+
+
+def harvest_windows(plan, new_session, write, workers=WINDOW_WORKERS):
+    """
+    Harvest the windows of a plan that aren't done, up to workers at a
+    time. Each window gets a session of its own, made by new_session
+    and reused by later windows. write is called with each page of
+    records not already written by another window, one page at a time.
+    """
+    sessions = Queue.Queue()
+    lock = threading.Lock()
+
+    def run(window):
+        begin, end, num = window
+        try:
+            session = sessions.get_nowait()
+        except Queue.Empty:
+            session = new_session()
+        checkpoint = plan.checkpoint(begin, end)
+        try:
+            for recs in harvest(checkpoint.query, session, checkpoint, count=plan.count):
+                with lock:
+                    new = [rec for rec in recs if get_ut(rec) not in plan.uts]
+                    if new:
+                        write(new)
+                        plan.written([get_ut(rec) for rec in new])
+        finally:
+            sessions.put(session)
+        with lock:
+            plan.window_done(begin, end)
+        return window
+
+    pool = ThreadPool(workers)
+    try:
+        for begin, end, num in pool.imap_unordered(run, plan.pending()):
+            logger.info("Harvested {} to {}, {} records found.".format(begin, end, num))
+    finally:
+        pool.terminate()
+        pool.join()
+    plan.finish()
+
+
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    ut TEXT PRIMARY KEY,
+    hash TEXT
+);
+CREATE TABLE IF NOT EXISTS harvests (
+    query TEXT PRIMARY KEY,
+    end TEXT
+);
+CREATE TABLE IF NOT EXISTS unfinished (
+    query TEXT,
+    start TEXT,
+    end TEXT,
+    PRIMARY KEY (query, start)
+);
+"""
+
+
+class HarvestManifest(object):
+    """
+    Content hash of each record written to an output directory, by UT,
+    the end of the last complete harvest of each query and the date
+    range of harvests that haven't finished.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # Windows write from worker threads, one at a time.
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.executescript(MANIFEST_SCHEMA)
+
+    def unchanged(self, ut, raw):
+        """
+        True if the record was written before with the same content.
+        """
+        row = self.conn.execute("SELECT hash FROM records WHERE ut = ?", (ut,)).fetchone()
+        return (row is not None) and (row[0] == content_hash(raw))
+
+    def put(self, ut, raw):
+        self.conn.execute("INSERT OR REPLACE INTO records (ut, hash) VALUES (?, ?)", (ut, content_hash(raw)))
+
+    def commit(self):
+        self.conn.commit()
+
+    def last_harvest(self, query):
+        """
+        End date of the last complete harvest of a query, or None.
+        """
+        row = self.conn.execute("SELECT end FROM harvests WHERE query = ?", (query,)).fetchone()
+        return None if row is None else row[0]
+
+    def unfinished(self, query, start):
+        """
+        End date of a harvest of a query from start that was begun but
+        didn't finish, or None.
+        """
+        row = self.conn.execute("SELECT end FROM unfinished WHERE query = ? AND start = ?", (query, start)).fetchone()
+        return None if row is None else row[0]
+
+    def begun(self, query, start, end):
+        """
+        Record the date range of a harvest about to run. Checkpoints
+        are keyed on the full query, so a rerun has to ask for the same
+        end to resume.
+        """
+        self.conn.execute("INSERT OR REPLACE INTO unfinished (query, start, end) VALUES (?, ?, ?)", (query, start, end))
+        self.conn.commit()
+
+    def harvested(self, query, end):
+        """
+        Record a complete harvest of a query up to end. An earlier end
+        than the one recorded is ignored.
+        """
+        last = self.last_harvest(query)
+        if (last is None) or (end > last):
+            self.conn.execute("INSERT OR REPLACE INTO harvests (query, end) VALUES (?, ?)", (query, end))
+        self.conn.execute("DELETE FROM unfinished WHERE query = ?", (query,))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,73 @@
+"""
+Content-addressed cache of per-record results.
+
+Results are stored under a hash of the record's raw XML, so a record
+that hasn't changed since it was last processed finds its result and a
+new or changed record misses. Entries that a full run didn't use
+belong to deleted or replaced records and can be pruned.
+"""
+
+import hashlib
+import sqlite3
+import time
+
+# Commit after this many writes.
+COMMIT_EVERY = 1000
+
+
+def content_hash(raw):
+    return hashlib.md5(raw).hexdigest()
+
+
+class HashCache(object):
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.text_factory = str
+        # Readers in pool processes don't block the writer.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, data TEXT, used REAL)")
+        self.conn.commit()
+        self.started = time.time()
+        self._pending = 0
+
+    def _wrote(self):
+        self._pending += 1
+        if self._pending >= COMMIT_EVERY:
+            self.conn.commit()
+            self._pending = 0
+
+    def __contains__(self, key):
+        """
+        Check for a key without marking it used.
+        """
+        row = self.conn.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone()
+        return row is not None
+
+    def get(self, key):
+        row = self.conn.execute("SELECT data FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.conn.execute("UPDATE cache SET used = ? WHERE key = ?", (self.started, key))
+        self._wrote()
+        return row[0]
+
+    def put(self, key, data):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cache (key, data, used) VALUES (?, ?, ?)",
+            (key, data, self.started)
+        )
+        self._wrote()
+
+    def prune(self):
+        """
+        Remove entries not used since this cache was opened.
+        """
+        cur = self.conn.execute("DELETE FROM cache WHERE used < ?", (self.started,))
+        self.conn.commit()
+        return cur.rowcount
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,128 @@
+"""
+Journal of completed update batches.
+
+A load is identified by a key built from the content hash of what is
+being posted, the named graph and the operation. Each completed batch is
+recorded by its line offset and length, so a rerun of a failed load can
+skip the lines that already made it to VIVO.
+
+Entries for a load go when it finishes, when a load of other content
+to the same graph starts, or when prune() finds them too old.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    load_key TEXT,
+    start INTEGER,
+    count INTEGER,
+    recorded REAL,
+    PRIMARY KEY (load_key, start)
+);
+"""
+
+
+def load_key(content_hash, named_graph, op):
+    return "{}\t{}\t{}".format(content_hash, named_graph, op)
+
+
+def file_hash(path):
+    """
+    md5 of a file, read in blocks.
+    """
+    h = hashlib.md5()
+    with open(path, 'rb') as inf:
+        for block in iter(lambda: inf.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def lines_hash(lines):
+    h = hashlib.md5()
+    for line in lines:
+        h.update(line)
+    return h.hexdigest()
+
+
+class BatchJournal(object):
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # Batches can be posted from worker threads.
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.executescript(SCHEMA)
+        try:
+            # Journals from before entries were timestamped.
+            self.conn.execute("ALTER TABLE batches ADD COLUMN recorded REAL")
+        except sqlite3.OperationalError:
+            pass
+        self._lock = threading.Lock()
+
+    def resume_offset(self, key):
+        """
+        Number of lines from the start of the load that are known to be
+        posted. Batches after a gap don't count.
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT start, count FROM batches WHERE load_key = ? ORDER BY start",
+                (key,)
+            ).fetchall()
+        offset = 0
+        for start, count in rows:
+            if start > offset:
+                break
+            offset = max(offset, start + count)
+        return offset
+
+    def record(self, key, start, count):
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO batches (load_key, start, count, recorded) VALUES (?, ?, ?, ?)",
+                (key, start, count, time.time())
+            )
+            self.conn.commit()
+
+    def finish(self, key):
+        """
+        Forget a load once all of it is posted.
+        """
+        with self._lock:
+            self.conn.execute("DELETE FROM batches WHERE load_key = ?", (key,))
+            self.conn.commit()
+
+    def supersede(self, key):
+        """
+        Forget other loads to the same graph with the same operation.
+        Their content has been replaced, so they'll never resume.
+        """
+        suffix = key[key.index("\t"):]
+        with self._lock:
+            cur = self.conn.execute(
+                "DELETE FROM batches WHERE substr(load_key, -?) = ? AND load_key != ?",
+                (len(suffix), suffix, key)
+            )
+            self.conn.commit()
+        return cur.rowcount
+
+    def prune(self, max_age):
+        """
+        Forget loads with no batch recorded in the last max_age
+        seconds. Returns the number of entries removed.
+        """
+        with self._lock:
+            cur = self.conn.execute(
+                "DELETE FROM batches WHERE load_key IN ("
+                "SELECT load_key FROM batches GROUP BY load_key HAVING MAX(COALESCE(recorded, 0)) < ?)",
+                (time.time() - max_age,)
+            )
+            self.conn.commit()
+        return cur.rowcount
+
+    def close(self):
+        self.conn.close()
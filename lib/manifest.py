@@ -0,0 +1,212 @@
+"""
+Persistent manifest of the harvested record corpus.
+
+Keeps the path, UT, size and mtime of every record file, plus entries
+for records in a segment store, in SQLite. refresh_files() only lists
+shard directories whose mtime changed and refresh_segments() only reads
+segment index lines written since the last refresh, so keeping the
+manifest current is cheap when little has landed. A file rewritten in
+place doesn't change its directory's mtime, so its stored size and
+mtime go stale unless refresh_files() is asked to stat every file.
+"""
+
+import glob
+import os
+import random
+import sqlite3
+
+from lib.segments import INDEX_NAME
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    path TEXT PRIMARY KEY,
+    ut TEXT,
+    size INTEGER,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS records_ut ON records (ut);
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def ut_from_path(path):
+    """
+    Record files are named by UT without the WOS: prefix.
+    """
+    return "WOS:" + os.path.splitext(os.path.basename(path))[0]
+
+
+class Manifest(object):
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.text_factory = str
+        self.conn.executescript(SCHEMA)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def _get_state(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def _set_state(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+    def _put(self, path, ut, size, mtime):
+        # Update in place so existing rows keep their rowid, which
+        # sample() depends on.
+        cur = self.conn.execute(
+            "UPDATE records SET ut = ?, size = ?, mtime = ? WHERE path = ?",
+            (ut, size, mtime, path)
+        )
+        if cur.rowcount == 0:
+            self.conn.execute(
+                "INSERT INTO records (path, ut, size, mtime) VALUES (?, ?, ?, ?)",
+                (path, ut, size, mtime)
+            )
+
+    def _dir_records(self, path):
+        prefix = os.path.join(path, "")
+        rows = self.conn.execute(
+            "SELECT path FROM records WHERE substr(path, 1, ?) = ?",
+            (len(prefix), prefix)
+        )
+        # Skip files in nested directories.
+        return [fn for (fn,) in rows.fetchall() if os.path.dirname(fn) == path]
+
+    def _scan_dir(self, path, file_pattern):
+        """
+        Bring the records for one shard directory up to date.
+        """
+        found = set()
+        for fn in glob.glob(os.path.join(path, file_pattern)):
+            st = os.stat(fn)
+            found.add(fn)
+            self._put(fn, ut_from_path(fn), st.st_size, st.st_mtime)
+        for fn in self._dir_records(path):
+            if fn not in found:
+                self.conn.execute("DELETE FROM records WHERE path = ?", (fn,))
+        return len(found)
+
+    def _check_dir(self, path):
+        """
+        Update the size and mtime of known files in a directory that
+        hasn't had files added or removed. Returns the number updated.
+        """
+        changed = 0
+        prefix = os.path.join(path, "")
+        rows = self.conn.execute(
+            "SELECT path, size, mtime FROM records WHERE substr(path, 1, ?) = ?",
+            (len(prefix), prefix)
+        ).fetchall()
+        for fn, size, mtime in rows:
+            if os.path.dirname(fn) != path:
+                continue
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            if (st.st_size != size) or (st.st_mtime != mtime):
+                self._put(fn, ut_from_path(fn), st.st_size, st.st_mtime)
+                changed += 1
+        return changed
+
+    def refresh_files(self, pattern, check_files=False):
+        """
+        Rescan the shard directories matched by the directory part of
+        a record glob such as 'data/pubs/*/*.xml'. Only directories
+        with files added or removed are looked at, so records
+        rewritten in place keep their old size and mtime. check_files
+        also stats the known files of every other directory, which is
+        slow on large or network file systems.
+        """
+        dir_pattern, file_pattern = os.path.split(pattern)
+        known = dict(self.conn.execute("SELECT path, mtime FROM dirs").fetchall())
+        scanned = 0
+        for path in glob.glob(dir_pattern):
+            if not os.path.isdir(path):
+                continue
+            mtime = os.stat(path).st_mtime
+            if known.pop(path, None) != mtime:
+                self._scan_dir(path, file_pattern)
+                self.conn.execute("INSERT OR REPLACE INTO dirs (path, mtime) VALUES (?, ?)", (path, mtime))
+                scanned += 1
+            elif check_files:
+                self._check_dir(path)
+        # Directories that have gone away.
+        for path in known:
+            for fn in self._dir_records(path):
+                self.conn.execute("DELETE FROM records WHERE path = ?", (fn,))
+            self.conn.execute("DELETE FROM dirs WHERE path = ?", (path,))
+        self.conn.commit()
+        return scanned
+
+    def refresh_segments(self, store_path, make_ref):
+        """
+        Add index lines appended to a segment store since the last
+        refresh. make_ref turns (segment, offset, length) into the
+        path recorded for the entry.
+        """
+        index_path = os.path.join(store_path, INDEX_NAME)
+        if not os.path.exists(index_path):
+            return 0
+        key = "segment-offset:" + index_path
+        offset = int(self._get_state(key, 0))
+        if offset > os.path.getsize(index_path):
+            # Index was replaced. Start over.
+            self.conn.execute("DELETE FROM records WHERE mtime IS NULL")
+            offset = 0
+        added = 0
+        with open(index_path) as inf:
+            inf.seek(offset)
+            while True:
+                line = inf.readline()
+                if not line.endswith("\n"):
+                    # Partly written line. Pick it up next time.
+                    break
+                ut, seg, start, length = line.rstrip("\n").split("\t")
+                ref = make_ref(int(seg), int(start), int(length))
+                # A newer copy of a record replaces the older one.
+                self.conn.execute("DELETE FROM records WHERE ut = ? AND mtime IS NULL AND path != ?", (ut, ref))
+                self._put(ref, ut, int(length), None)
+                offset += len(line)
+                added += 1
+        self._set_state(key, str(offset))
+        self.conn.commit()
+        return added
+
+    def paths(self):
+        return [row[0] for row in self.conn.execute("SELECT path FROM records ORDER BY rowid")]
+
+    def sample(self, num, seed):
+        """
+        A sample of record paths that is the same for the same seed and
+        manifest.
+        """
+        rowids = [row[0] for row in self.conn.execute("SELECT rowid FROM records ORDER BY rowid")]
+        chosen = random.Random(seed).sample(rowids, num)
+        out = []
+        # Stay under SQLite's limit on bound parameters.
+        for i in xrange(0, len(chosen), 500):
+            chunk = chosen[i:i + 500]
+            rows = self.conn.execute(
+                "SELECT rowid, path FROM records WHERE rowid IN ({})".format(",".join("?" * len(chunk))),
+                chunk
+            )
+            by_id = dict(rows.fetchall())
+            out += [by_id[rid] for rid in chunk]
+        return out
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,63 @@
+"""
+Helpers for writing N-Triples without serializing an rdflib Graph.
+"""
+
+from collections import OrderedDict
+import hashlib
+
+from rdflib.plugins.serializers.nt import _nt_row
+
+# Number of distinct lines remembered by NTriplesSink when dropping
+# repeated triples.
+DEDUPE_WINDOW = 200000
+
+
+def nt_line(triple):
+    """
+    Format a triple as a line of N-Triples, the same way
+    Graph.serialize(format='nt') does.
+    """
+    return _nt_row(triple).encode("ascii", "_rdflib_nt_escape")
+
+
+class NTriplesSink(object):
+    """
+    Write N-Triples lines to a file as they are produced.
+
+    A line repeated within the last `window` distinct lines is dropped.
+    Only a digest of each line is kept, so memory is bounded by the
+    window size rather than the size of the output.
+    """
+
+    def __init__(self, out_file, window=DEDUPE_WINDOW):
+        self.out_file = out_file
+        self.window = window
+        self._seen = OrderedDict()
+        self.written = 0
+        self.skipped = 0
+
+    def write_line(self, line):
+        key = hashlib.md5(line).digest()
+        if key in self._seen:
+            # Move to the end so frequently repeated lines stay in the window.
+            del self._seen[key]
+            self._seen[key] = True
+            self.skipped += 1
+            return False
+        self._seen[key] = True
+        if len(self._seen) > self.window:
+            self._seen.popitem(last=False)
+        self.out_file.write(line)
+        self.written += 1
+        return True
+
+    def write_lines(self, lines):
+        for line in lines:
+            self.write_line(line)
+
+    def add(self, triple):
+        return self.write_line(nt_line(triple))
+
+    def add_all(self, triples):
+        for triple in triples:
+            self.add(triple)
@@ -0,0 +1,170 @@
+"""
+Append-only segment files for harvested WoS records.
+
+Records are appended to numbered segment files rather than written one
+per file. An index file maps each UT to the segment, offset and length
+of its latest copy. Writing a UT again appends a new copy and index
+line; the last index line for a UT wins.
+"""
+
+import mmap
+import os
+
+# Start a new segment once the current one reaches this size.
+SEGMENT_SIZE = 256 * 1024 * 1024
+
+INDEX_NAME = "index.tsv"
+
+
+def _trim_partial_line(path, block_size=4096):
+    """
+    Truncate a file after its last newline, dropping a line left
+    partly written by a crash.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        pos = end
+        while pos > 0:
+            start = max(0, pos - block_size)
+            f.seek(start)
+            block = f.read(pos - start)
+            newline = block.rfind("\n")
+            if newline >= 0:
+                pos = start + newline + 1
+                break
+            pos = start
+        if pos < end:
+            f.truncate(pos)
+
+
+class SegmentStore(object):
+    """
+    Read and append records in a directory of segment files.
+    """
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        self._index = None
+        self._maps = {}
+        self._segment = None
+        self._segment_num = None
+        self._index_file = None
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, INDEX_NAME))
+
+    def segment_path(self, num):
+        return os.path.join(self.path, "seg-{:05d}.dat".format(num))
+
+    @property
+    def index(self):
+        """
+        UT -> (segment, offset, length), loaded on first use.
+        """
+        if self._index is None:
+            index = {}
+            index_path = os.path.join(self.path, INDEX_NAME)
+            if os.path.exists(index_path):
+                with open(index_path) as inf:
+                    for line in inf:
+                        if not line.endswith("\n"):
+                            # Partly written line, from a crash or a
+                            # writer that hasn't flushed yet.
+                            break
+                        ut, seg, offset, length = line.rstrip("\n").split("\t")
+                        index[ut] = (int(seg), int(offset), int(length))
+            self._index = index
+        return self._index
+
+    def __contains__(self, ut):
+        return ut in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def uts(self):
+        return sorted(self.index)
+
+    def _open_segment(self):
+        if self._segment is not None:
+            if self._segment.tell() < self.segment_size:
+                return self._segment
+            self._segment.close()
+            self._segment_num += 1
+        else:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            self._segment_num = 0
+            while os.path.exists(self.segment_path(self._segment_num + 1)):
+                self._segment_num += 1
+        self._segment = open(self.segment_path(self._segment_num), 'ab')
+        # Append mode doesn't move the position until the first write.
+        self._segment.seek(0, os.SEEK_END)
+        if self._index_file is None:
+            index_path = os.path.join(self.path, INDEX_NAME)
+            _trim_partial_line(index_path)
+            self._index_file = open(index_path, 'a')
+        return self._segment
+
+    def put(self, ut, data):
+        """
+        Append a record. Returns its (segment, offset, length).
+        """
+        seg_file = self._open_segment()
+        offset = seg_file.tell()
+        seg_file.write(data)
+        # The index file can flush on its own once its buffer fills, so
+        # push the data out first; an index line must never point past
+        # the data it indexes.
+        seg_file.flush()
+        loc = (self._segment_num, offset, len(data))
+        self.index[ut] = loc
+        self._index_file.write("{}\t{}\t{}\t{}\n".format(ut, *loc))
+        return loc
+
+    def flush(self):
+        # Data before index, so index lines never point past the data.
+        if self._segment is not None:
+            self._segment.flush()
+        if self._index_file is not None:
+            self._index_file.flush()
+
+    def _map(self, seg, end):
+        mm = self._maps.get(seg)
+        if (mm is None) or (len(mm) < end):
+            # Segment is new or has grown since it was mapped.
+            if mm is not None:
+                mm.close()
+            self.flush()
+            with open(self.segment_path(seg), 'rb') as inf:
+                mm = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[seg] = mm
+        return mm
+
+    def read_at(self, seg, offset, length):
+        """
+        Read a record by location. Returns a buffer over the mapped
+        segment rather than a copy; ET.fromstring accepts it directly.
+        """
+        mm = self._map(seg, offset + length)
+        return buffer(mm, offset, length)
+
+    def get(self, ut):
+        return self.read_at(*self.index[ut])
+
+    def close(self):
+        self.flush()
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+        for mm in self._maps.values():
+            mm.close()
+        self._maps = {}
@@ -0,0 +1,95 @@
+"""
+Local snapshots of what was last written to each named graph.
+
+A snapshot is an N-Triples file plus the triple count the graph had
+when it was written. If the graph still has that many triples, the
+snapshot is used instead of downloading the graph again. Writes that
+don't go through a sync drop the snapshot, so a count check only has to
+catch changes made outside this code.
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+
+from lib.ntriples import nt_line
+
+
+class GraphSnapshots(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def _base(self, named_graph):
+        return os.path.join(self.path, hashlib.md5(named_graph).hexdigest())
+
+    def nt_path(self, named_graph):
+        return self._base(named_graph) + ".nt"
+
+    def count(self, named_graph):
+        """
+        Triple count recorded with the snapshot, or None if there isn't
+        one.
+        """
+        try:
+            with open(self._base(named_graph) + ".count") as inf:
+                return int(inf.read())
+        except (IOError, ValueError):
+            return None
+
+    def age(self, named_graph):
+        """
+        Seconds since the snapshot was written, or None if there isn't
+        one.
+        """
+        try:
+            return time.time() - os.path.getmtime(self._base(named_graph) + ".count")
+        except OSError:
+            return None
+
+    def _mkstemp(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+        os.close(fd)
+        return tmp_path
+
+    def _commit(self, named_graph, tmp_path, num):
+        self.drop(named_graph)
+        os.rename(tmp_path, self.nt_path(named_graph))
+        # Count last. A snapshot without a count is never used.
+        with open(self._base(named_graph) + ".count", 'w') as out_file:
+            out_file.write(str(num))
+
+    def save(self, named_graph, triples):
+        """
+        Save triples as the graph's snapshot.
+        """
+        tmp_path = self._mkstemp()
+        num = 0
+        with open(tmp_path, 'w') as out_file:
+            for triple in triples:
+                out_file.write(nt_line(triple))
+                num += 1
+        self._commit(named_graph, tmp_path, num)
+        return num
+
+    def save_lines(self, named_graph, lines):
+        """
+        Save distinct N-Triples lines as the graph's snapshot.
+        """
+        tmp_path = self._mkstemp()
+        num = 0
+        with open(tmp_path, 'w') as out_file:
+            for line in lines:
+                out_file.write(line)
+                num += 1
+        self._commit(named_graph, tmp_path, num)
+        return num
+
+    def drop(self, named_graph):
+        for ext in (".count", ".nt"):
+            fpath = self._base(named_graph) + ext
+            if os.path.exists(fpath):
+                os.remove(fpath)
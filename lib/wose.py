@@ -2,10 +2,14 @@
 Minimal client for query Web of Science Web Services Expanded.
 """
 import base64
+from collections import deque
 import math
+from multiprocessing.pool import ThreadPool
 import os
 import re
 from string import Template
+import threading
+import time
 import xml.etree.ElementTree as ET
 
 import logging
@@ -21,6 +25,12 @@ NS = {
     'rec': 'http://scientific.thomsonreuters.com/schema/wok5.4/public/FullRecord'
 }
 
+# Pages of a query retrieved at once.
+RETRIEVE_WORKERS = 4
+# Most requests sent per second, across all workers. WoS throttles
+# sessions that go faster.
+MAX_REQUESTS_PER_SECOND = 2.0
+
 # SOAP message for authenticating.
 AUTHENTICATE = """
 <soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
@@ -88,24 +98,74 @@ class ExceedsException(Exception):
     def __init__(self,*args,**kwargs):
         Exception.__init__(self,*args,**kwargs)
 
+# Fault codes, the bracketed prefix of a faultstring, for an expired or
+# unknown session and for a query ID WoS no longer knows.
+SESSION_FAULTS = ("WSE0002",)
+QUERY_ID_FAULTS = ("ESE0003",)
+
+
+class WosFault(Exception):
+    """
+    SOAP fault returned by WoS. code is the fault code, or None if the
+    response didn't have one.
+    """
+
+    def __init__(self, msg, code=None):
+        Exception.__init__(self, msg)
+        self.code = code
+
+
+class SessionException(WosFault):
+    """
+    The session ID has expired or isn't valid.
+    """
+
+
+class QueryIdException(WosFault):
+    """
+    The query ID is no longer known to WoS, e.g. after the session that
+    ran the query ended.
+    """
+
+
+def fault_code(msg):
+    match = re.match("\\((\\w+)\\)", (msg or "").strip())
+    if match is None:
+        return None
+    return match.group(1)
+
+
 def get_error_message(raw):
     doc = ET.fromstring(raw)
     msg = doc.find('.//faultstring').text
     if msg.startswith('(IIE0022)'):
         raise ExceedsException(msg)
+    return msg
+
+
+def raise_fault(rsp):
+    """
+    Raise the exception matching the fault code of a response.
+    """
+    try:
+        msg = get_error_message(rsp.text.encode('utf-8', 'ignore'))
+    except (ET.ParseError, AttributeError):
+        msg = rsp.text
+    logger.error(msg)
+    code = fault_code(msg)
+    if code in SESSION_FAULTS:
+        raise SessionException(msg, code)
+    if code in QUERY_ID_FAULTS:
+        raise QueryIdException(msg, code)
+    raise WosFault(msg, code)
 
 
 def get_pages(initial, total, psize=50):
-    more_pages = math.ceil(float(total - initial)/ psize)
-    for pg in range(int(more_pages)):
-        pnum = pg + 1
-        if pnum == 1:
-            start = initial
-        else:
-            start = start + psize
-        if start > total:
-            break
-        yield start
+    """
+    firstRecord of each page of psize records after the first initial
+    records, up to total. Records are numbered from 1.
+    """
+    return range(initial + 1, total + 1, psize)
 
 
 class Session(object):
@@ -150,9 +210,30 @@ class Session(object):
             raise Exception("Failed to close WoS session")
 
 
+class RateLimiter(object):
+    """
+    Spaces calls to wait() at least 1 / rate seconds apart across
+    threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            at = max(now, self._next)
+            self._next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
 class Client(object):
-    def __init__(self, sid):
+    def __init__(self, sid, url=None):
         self.sid = sid
+        self.url = url
 
     def sid_header(self):
         if self.sid is None:
@@ -160,13 +241,15 @@ class Client(object):
         else:
             return {"Cookie": "SID=\"" + self.sid + "\""}
 
+    def search_url(self):
+        return self.url or SEARCH_URL
+
     def query(self, query_doc):
-        rsp = requests.post(SEARCH_URL, data=query_doc, headers=self.sid_header())
+        rsp = requests.post(self.search_url(), data=query_doc, headers=self.sid_header())
         logger.debug("WOS query:\n {}".format(query_doc))
         logger.debug("Query status code: {}".format(rsp.status_code))
         if rsp.status_code != 200:
-            logger.error(rsp.text)
-            raise Exception("Query error")
+            raise_fault(rsp)
         rsp_doc = ET.fromstring(rsp.text.encode('utf-8', 'ignore'))
         found = rsp_doc.find('.//recordsFound').text
         qid = rsp_doc.find('.//queryId').text
@@ -176,16 +259,15 @@ class Client(object):
         return qid, int(found), xml
 
     def retrieve(self, query_doc):
-        rsp = requests.post(SEARCH_URL, data=query_doc, headers=self.sid_header())
+        rsp = requests.post(self.search_url(), data=query_doc, headers=self.sid_header())
         logger.debug("WOS query:\n {}".format(query_doc))
         logger.debug("Query status code: {}".format(rsp.status_code))
-        if rsp.status_code == 500:
+        if rsp.status_code != 200:
             try:
-                emsg = get_error_message(rsp.text)
+                raise_fault(rsp)
             except ExceedsException:
                 # No problem here just a deduplication issue.
                 return ""
-            logger.warning(emsg)
         rsp_doc = ET.fromstring(rsp.text.encode('utf-8', 'ignore'))
         try:
             records = rsp_doc.find('.//records').text
@@ -200,53 +282,93 @@ def get_recs(raw):
     return ET.fromstring(raw.encode('utf-8', 'ignore')).findall('.//REC')
 
 
-def query(q, sid, count=100, get_all=False):
+def retrieve_pages(client, qid, starts, workers=RETRIEVE_WORKERS, rate=None):
+    """
+    Retrieve pages of a query, up to workers at a time and no more than
+    rate requests a second, MAX_REQUESTS_PER_SECOND by default. Yields
+    each page's records XML in the order of starts.
+    """
+    limiter = RateLimiter(rate or MAX_REQUESTS_PER_SECOND)
+
+    def fetch(start):
+        limiter.wait()
+        logger.info("Batch start {}.".format(start))
+        rq = RETRIEVE.substitute(qid=qid, start=start)
+        return client.retrieve(rq).strip()
+
+    if workers <= 1:
+        for start in starts:
+            yield fetch(start)
+        return
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for start in starts:
+            # Keep up to two pages per worker ahead of the reader, so the
+            # workers stay busy while it handles a page.
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(fetch, (start,)))
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def iter_raw_query(q, sid, count=100, workers=RETRIEVE_WORKERS):
+    """
+    Send a full SOAP message for a query and stream the whole result
+    set. Returns the query ID, the number of records found and a
+    generator of pages, each a list of REC elements. Only the first page
+    is fetched up front, so callers can handle each page and let it go
+    before the next arrives.
+    """
     wq = Client(sid)
+    logger.info("QUERY:\n" + q)
+    qid, num, records = wq.query(q)
+    logger.info("Found {} records for search.".format(num))
+
+    def pages():
+        yield get_recs(records)
+        # are there more records to fetch?
+        if num > count:
+            for recs in retrieve_pages(wq, qid, get_pages(count, num), workers=workers):
+                yield get_recs(recs)
+
+    return qid, num, pages()
+
+
+def query(q, sid, count=100, get_all=False, workers=RETRIEVE_WORKERS):
     fq = QUERY.substitute(query=q, count=count)
-    logger.info("QUERY:\n" + fq)
-    out_recs = []
     if get_all is False:
+        wq = Client(sid)
+        logger.info("QUERY:\n" + fq)
         qid, num, records = wq.query(fq)
-        out_recs += get_recs(records)
-    else:
-        qid, num, records = wq.query(fq)
-        out_recs += get_recs(records)
-        # are there more records to fetch?
-        if num > count:
-            for start in get_pages(count, num):
-                logger.debug("Batch start {}. Batch size {}.".format(start, count))
-                # Build retrieve query
-                rq = RETRIEVE.substitute(qid=qid, start=start)
-                logger.debug(rq)
-                recs = wq.retrieve(rq).strip()
-                out_recs += get_recs(recs)
+        return qid, num, get_recs(records)
+    qid, num, pages = iter_raw_query(fq, sid, count=count, workers=workers)
+    out_recs = []
+    for recs in pages:
+        out_recs += recs
     return qid, num, out_recs
 
 
-def raw_query(q, sid, count=100, get_all=False):
+def raw_query(q, sid, count=100, get_all=False, workers=RETRIEVE_WORKERS):
     """
-    Use for sending in full SOAP message for a query.
+    Use for sending in full SOAP message for a query. With get_all,
+    the remaining pages are retrieved by up to workers at a time. See
+    iter_raw_query for handling large result sets a page at a time.
     """
-    wq = Client(sid)
-    logger.info("QUERY:\n" + q)
-    out_recs = []
     if get_all is False:
+        wq = Client(sid)
+        logger.info("QUERY:\n" + q)
         qid, num, records = wq.query(q)
         logger.info("Found {} records for search.".format(num))
         return qid, num, get_recs(records)
-    else:
-        qid, num, records = wq.query(q)
-        out_recs += get_recs(records)
-        # are there more records to fetch?
-        if num > count:
-            for start in get_pages(count, num):
-                logger.info("Batch start {}. Batch size {}.".format(start, count))
-                # Build retrieve query
-                rq = RETRIEVE.substitute(qid=qid, start=start)
-                logger.debug(rq)
-                recs = wq.retrieve(rq).strip()
-                tr = get_recs(recs)
-                out_recs += tr
+    qid, num, pages = iter_raw_query(q, sid, count=count, workers=workers)
+    out_recs = []
+    for recs in pages:
+        out_recs += recs
     return qid, num, out_recs
 
 
@@ -3,44 +3,101 @@ Command-line script for posting RDF files to the VIVO API.
 """
 
 import argparse
+from collections import deque
+from multiprocessing.pool import ThreadPool
 import os
 import time
 
 from rdflib import Graph
 
 from lib import backend
+from lib.graphdiff import read_nt_lines
 from settings import logger
 
 NG_BASE = "http://localhost/data/"
 
-# Number of triples to post to VIVO SPARQL Update endpoint at one time.
-# Larger batches tend to fail with 403 error.
+# Batch size to start from. Larger batches tend to fail with 403 error.
+# The size then adapts to how VIVO responds. See backend.BatchController.
 DEFAULT_BATCH_SIZE = 5000
 
 
-def process(triple_files, format="nt", dry=False, sync=False, sleep=10, size=DEFAULT_BATCH_SIZE):
-    vstore = backend.get_store()
-    for fpath in triple_files:
-        g = Graph()
-        g.parse(source=fpath, format=format)
-        named_graph = NG_BASE + fpath.split("/")[-1].split(".")[0]
-        logger.info("Processing updates with {} triples to {} and batch size {}.".format(len(g), named_graph, size))
+# Files prepared ahead of the one being posted.
+DEFAULT_AHEAD = 2
+
+
+def graph_name(fpath):
+    return NG_BASE + fpath.split("/")[-1].split(".")[0]
+
+
+def prepare(fpath, format="nt", sync=False, dry=False):
+    """
+    Parse and diff a file, ready to post. Runs in a background thread.
+    A dry run doesn't read from VIVO, so a sync isn't diffed.
+    """
+    named_graph = graph_name(fpath)
+    if dry is True:
+        sync = False
+    if format == "nt":
+        # Stream the lines rather than loading the file as a graph.
+        if sync is True:
+            logger.info("Diffing {} against {}.".format(fpath, named_graph))
+            return backend.prepare_nt_sync(named_graph, fpath)
+        return backend.prepare_nt_add(named_graph, fpath)
+    g = Graph()
+    g.parse(source=fpath, format=format)
+    logger.info("Preparing updates with {} triples to {}.".format(len(g), named_graph))
+    return backend.prepare_graph(named_graph, g, sync=sync)
+
+
+def post(load, dry=False, sleep=0):
+    """
+    Post a prepared load. Only the main thread posts, so VIVO sees one
+    writer.
+    """
+    try:
+        named_graph = load.named_graph
         if dry is True:
-            logger.info("Dry run. No changes made.")
+            num_adds = load.num_adds
+            if num_adds is None:
+                num_adds = sum(1 for line in read_nt_lines(load.adds_path))
+            logger.info("Would post {} triples to {}.".format(num_adds, named_graph))
+            logger.info("Dry run. VIVO wasn't read or changed.")
+            return
+        added, removed = load.post()
+        if (added > 0) or (removed > 0):
+            if sleep > 0:
+                logger.info("Sleeping for {} seconds between files.".format(sleep))
+                time.sleep(sleep)
         else:
-            if sync is True:
-                logger.info("Syncing graph to {}.".format(named_graph))
-                added, removed = backend.sync_updates(named_graph, g, size=size)
-            else:
-                logger.info("Posting graph as updates to {}.".format(named_graph))
-                added = vstore.bulk_add(named_graph, g, size=size)
-                removed = 0
-            if (added > 0) or (removed > 0):
-                if sleep > 0:
-                    logger.info("Sleeping for {} seconds between files.".format(sleep))
-                    time.sleep(sleep)
-            else:
-                logger.info("No changes made to {}.".format(named_graph))
+            logger.info("No changes made to {}.".format(named_graph))
+    finally:
+        load.close()
+
+
+def process(triple_files, format="nt", dry=False, sync=False, sleep=0, size=DEFAULT_BATCH_SIZE, ahead=DEFAULT_AHEAD):
+    """
+    Post files in order while up to `ahead` later files are prepared
+    in background threads. A file isn't prepared while an earlier file
+    for the same named graph is waiting to be posted.
+    """
+    backend.get_controller().seed(size)
+    pool = ThreadPool(max(1, ahead))
+    pending = deque()
+    try:
+        for fpath in triple_files:
+            named_graph = graph_name(fpath)
+            while pending and ((len(pending) > ahead) or (named_graph in [ng for ng, rsp in pending])):
+                post(pending.popleft()[1].get(), dry=dry, sleep=sleep)
+            pending.append((named_graph, pool.apply_async(prepare, (fpath, format, sync, dry))))
+        while pending:
+            post(pending.popleft()[1].get(), dry=dry, sleep=sleep)
+    finally:
+        pool.close()
+        pool.join()
+        # Clean up loads prepared before a failure.
+        for named_graph, rsp in pending:
+            if rsp.successful():
+                rsp.get().close()
     return True
 
 
@@ -53,11 +110,12 @@ def verify(paths):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Load triples')
     parser.add_argument('--dry-run', '-d', action="store_true", dest="dry", default=False, help="Dry run.")
-    parser.add_argument('--sync', '-s', action="store_true", dest="sync", default=False, help="Do graph sync rather than update.")
+    parser.add_argument('--sync', '-s', action="store_true", dest="sync", default=False, help="Do graph sync rather than update. The load strategy is planned per graph.")
     parser.add_argument('--path', '-p', action="store", nargs='*')
     parser.add_argument('--format', '-f', action="store", default="nt")
     parser.add_argument('--sleep', '-sp', action="store", default=0, type=int)
-    parser.add_argument('--batch', '-b', action="store", default=DEFAULT_BATCH_SIZE, type=int)
+    parser.add_argument('--batch', '-b', action="store", default=DEFAULT_BATCH_SIZE, type=int, help="Starting batch size.")
+    parser.add_argument('--ahead', '-a', action="store", default=DEFAULT_AHEAD, type=int, help="Files to prepare ahead of posting.")
     args = parser.parse_args()
     verify(args.path)
-    done = process(args.path, format=args.format, dry=args.dry, sync=args.sync, sleep=args.sleep, size=args.batch)
+    done = process(args.path, format=args.format, dry=args.dry, sync=args.sync, sleep=args.sleep, size=args.batch, ahead=args.ahead)
@@ -1,29 +1,36 @@
 """
 Map WoS full record XML to an extended VIVO ontology.
 
-This expects the XML to be on disk with one record per file.
-Path to these files can be specified in settings.py.
+This expects the XML to be on disk with one record per file, in the
+segment store written by fetch_pubs_xml.py, or in multi-record WoS
+exports that are streamed with iter_dump_records. Paths to these can
+be specified in settings.py.
 """
 
 import argparse
 import glob
-import random
+import gzip
+import json
 import sys
 import xml.etree.ElementTree as ET
 
 
 # installed
 from rdflib import Graph, Literal
-from rdflib.resource import Resource
 from slugify import slugify
 
 
 # local
 from lib import backend
+from lib.manifest import Manifest
+from lib.segments import SegmentStore
 from settings import (
     SEED,
     NS,
     RECORD_PATH,
+    DUMP_PATH,
+    SEGMENT_PATH,
+    MANIFEST_PATH,
     PUB_GRAPH,
     logger,
     DEPARTMENT_UNKNOWN_LABEL
@@ -66,91 +73,132 @@ def get_category_uri(name):
     return D['wosc-' + slugify(name)]
 
 
-def add_category(value):
+def to_graph(triples):
     """
-    Don't change category label even though they aren't consistent.
+    Collect triples from one of the *_triples generators into a Graph.
     """
     g = Graph()
+    for triple in triples:
+        g.add(triple)
+    return g
+
+
+def category_triples(value):
     uri = get_category_uri(value)
-    g.add((uri, RDF.type, WOS.Category))
-    g.add((uri, RDFS.label, Literal(value)))
-    return uri, g
+    yield (uri, RDF.type, WOS.Category)
+    yield (uri, RDFS.label, Literal(value))
+
+
+def add_category(value):
+    """
+    Don't change category label even though they aren't consistent.
+    """
+    return get_category_uri(value), to_graph(category_triples(value))
+
+
+def keyword_plus_uri(value):
+    return D['kwp-' + slugify(value)]
+
+
+def keyword_plus_triples(value, pub_uri):
+    uri = keyword_plus_uri(value)
+    yield (uri, RDF.type, WOS.KeywordPlus)
+    yield (uri, RDFS.label, Literal(value))
+    yield (pub_uri, WOS.hasKeywordPlus, uri)
 
 
 def add_keyword_plus(value, pub_uri):
     """
     Leave keywords plus as is.
     """
-    g = Graph()
-    slug = slugify(value)
-    uri = D['kwp-' + slug]
-    g.add((uri, RDF.type, WOS.KeywordPlus))
-    g.add((uri, RDFS.label, Literal(value)))
-    g.add((pub_uri, WOS.hasKeywordPlus, uri))
-    return uri, g
+    return keyword_plus_uri(value), to_graph(keyword_plus_triples(value, pub_uri))
+
+
+def keyword_plus_data_property_triples(value, pub_uri):
+    yield (pub_uri, WOS.keywordPlus, Literal(value))
 
 
 def add_keyword_plus_data_property(value, pub_uri):
     """
     Leave keywords plus as is.
     """
-    g = Graph()
-    g.add((pub_uri, WOS.keywordPlus, Literal(value)))
-    return g
+    return to_graph(keyword_plus_data_property_triples(value, pub_uri))
+
+
+def author_keyword_uri(value):
+    return D['akw-' + slugify(value)]
+
+
+def author_keyword_triples(value, pub_uri):
+    uri = author_keyword_uri(value)
+    yield (uri, RDF.type, WOS.AuthorKeyword)
+    yield (uri, RDFS.label, Literal(value))
+    yield (pub_uri, WOS.hasAuthorKeyword, uri)
 
 
 def add_author_keyword(value, pub_uri):
     """
     Leave author keywords as is.
     """
-    g = Graph()
-    slug = slugify(value)
-    uri = D['akw-' + slug]
-    g.add((uri, RDF.type, WOS.AuthorKeyword))
-    g.add((uri, RDFS.label, Literal(value)))
-    g.add((pub_uri, WOS.hasAuthorKeyword, uri))
-    return uri, g
+    return author_keyword_uri(value), to_graph(author_keyword_triples(value, pub_uri))
+
+
+def author_keyword_data_property_triples(value, pub_uri):
+    yield (pub_uri, WOS.authorKeyword, Literal(value))
 
 
 def add_author_keyword_data_property(value, pub_uri):
     """
     Leave keywords plus as is.
     """
-    g = Graph()
-    g.add((pub_uri, WOS.authorKeyword, Literal(value)))
-    return g
+    return to_graph(author_keyword_data_property_triples(value, pub_uri))
 
 
-def add_grant(grant, pub_uri):
+def grant_triples(grant, pub_uri):
     """
     Create a funder and grant(s).
     """
-    g = Graph()
     if grant.get("agency") is None:
         logger.info("No agency found for {} with ids.".format(pub_uri, ";".join(grant.get("ids", []))))
-        return g
+        return
     slug = slugify(grant["agency"])
     uri = D['funder-' + slug]
-    g.add((uri, RDF.type, WOS.Funder))
-    g.add((uri, RDFS.label, Literal(grant["agency"])))
+    yield (uri, RDF.type, WOS.Funder)
+    yield (uri, RDFS.label, Literal(grant["agency"]))
     for gid in grant["ids"]:
         label = "{} - {}".format(grant["agency"], gid)
         guri = D['grant-'] + slugify(label)
-        g.add((guri, RDF.type, WOS.Grant))
-        g.add((guri, RDFS.label, Literal(label)))
-        g.add((guri, WOS.grantId, Literal(gid)))
-        g.add((guri, VIVO.relates, uri))
-        g.add((guri, VIVO.relates, pub_uri))
-    return g
+        yield (guri, RDF.type, WOS.Grant)
+        yield (guri, RDFS.label, Literal(label))
+        yield (guri, WOS.grantId, Literal(gid))
+        yield (guri, VIVO.relates, uri)
+        yield (guri, VIVO.relates, pub_uri)
+
+
+def add_grant(grant, pub_uri):
+    """
+    Create a funder and grant(s).
+    """
+    return to_graph(grant_triples(grant, pub_uri))
 
 
 class WosRecord(object):
     """
-    Convert a XML string of WoS metadata to a Python object.
+    Convert a XML string, or an already parsed REC element, of WoS
+    metadata to a Python object.
     """
 
+    # Parsed authors and addresses, and the addresses indexed by
+    # number. Built on first use and kept for the life of the record.
+    _authors = None
+    _addresses = None
+    _address_index = None
+
     def __init__(self, xml_string):
-        self.rec = ET.fromstring(xml_string)
+        if ET.iselement(xml_string):
+            self.rec = xml_string
+        else:
+            self.rec = ET.fromstring(xml_string)
         self.ut = self.rec.find('UID', NS).text
         self.summary = self.rec.find('static_data/summary', NS)
         self.full = self.rec.find('static_data/fullrecord_metadata', NS)
@@ -248,6 +296,11 @@ class WosRecord(object):
         return ", ".join(out)
 
     def authors(self):
+        if self._authors is None:
+            self._authors = self._parse_authors()
+        return self._authors
+
+    def _parse_authors(self):
         out = []
         for au in self.summary.findall('names/name'):
             out.append(
@@ -267,6 +320,22 @@ class WosRecord(object):
         return out
 
     def addresses(self):
+        if self._addresses is None:
+            self._addresses = self._parse_addresses()
+        return self._addresses
+
+    def address_index(self):
+        """
+        Addresses keyed by address number.
+        """
+        if self._address_index is None:
+            index = {}
+            for addr in self.addresses():
+                index.setdefault(addr['number'], []).append(addr)
+            self._address_index = index
+        return self._address_index
+
+    def _parse_addresses(self):
         out = []
         for addr in self.full.findall('addresses/address_name', NS):
             spec = addr.find('address_spec')
@@ -362,6 +431,9 @@ class RDFRecord(WosRecord):
     Represent the WoS Record as RDF.
     """
 
+    # Address URIs keyed by address number. Built on first use.
+    _addr_uri_index = None
+
     @property
     def uri(self):
         return D[self.ln]
@@ -380,13 +452,12 @@ class RDFRecord(WosRecord):
         return D[ln]
 
     def addr_uris_from_number(self, number):
-        out = []
-        for addr in self.addresses():
-            num = addr['number']
-            if num == number:
-                faddr = addr["full_address"]
-                out.append(self.addr_uri(faddr, num))
-        return out
+        if self._addr_uri_index is None:
+            index = {}
+            for num, addrs in self.address_index().items():
+                index[num] = [self.addr_uri(addr["full_address"], num) for addr in addrs]
+            self._addr_uri_index = index
+        return self._addr_uri_index.get(number, [])
 
     @staticmethod
     def sub_org_uri(label):
@@ -449,15 +520,12 @@ class RDFRecord(WosRecord):
             return [WOS.Publication]
         return dtypes
 
-    def authorships(self):
-        g = Graph()
+    def authorship_triples(self):
         aus = self.authors()
         for au in aus:
             aship_uri = self.aship_uri(au['rank'])
-            r = Resource(g, aship_uri)
-            r.set(RDFS.label, Literal(au["display_name"]))
-            r.set(RDF.type, VIVO.Authorship)
-            r.set(VIVO.rank, Literal(au['rank']))
+            yield (aship_uri, RDFS.label, Literal(au["display_name"]))
+            yield (aship_uri, RDF.type, VIVO.Authorship)
             data_props = [
                 ('rank', VIVO.rank),
                 ('full_name', WOS.fullName),
@@ -472,9 +540,9 @@ class RDFRecord(WosRecord):
             for key, prop in data_props:
                 value = au.get(key)
                 if value is not None:
-                    r.set(prop, Literal(value))
+                    yield (aship_uri, prop, Literal(value))
             # relations
-            r.add(VIVO.relates, self.uri)
+            yield (aship_uri, VIVO.relates, self.uri)
             # relate to addresses too
             # address nums are a space separated list of numbers
             addr_nums = au["address"]
@@ -484,109 +552,106 @@ class RDFRecord(WosRecord):
                 for anum in addr_nums.split():
                     addr_uris = self.addr_uris_from_number(anum)
                     for auri in addr_uris:
-                        r.add(VIVO.relates, auri)
-        return g
+                        yield (aship_uri, VIVO.relates, auri)
 
-    def sub_orgs(self):
-        g = Graph()
+    def authorships(self):
+        return to_graph(self.authorship_triples())
+
+    def sub_org_triples(self):
         addresses = self.addresses()
         for addr in addresses:
-            ano = addr["number"]
             org = addr["organization"]
-            for idx, suborg in enumerate(addr['sub_organizations']):
+            for suborg in addr['sub_organizations']:
                 label = "{}, {}".format(suborg, org)
                 uri = self.sub_org_uri(label)
-                r = Resource(g, uri)
-                r.set(RDF.type, WOS.SubOrganization)
-                r.set(RDFS.label, Literal(label))
-                r.set(WOS.organizationName, Literal(org));
-                r.set(WOS.subOrganizationName, Literal(suborg))
-        return g
+                yield (uri, RDF.type, WOS.SubOrganization)
+                yield (uri, RDFS.label, Literal(label))
+                yield (uri, WOS.organizationName, Literal(org))
+                yield (uri, WOS.subOrganizationName, Literal(suborg))
 
-    def unified_orgs(self):
-        g = Graph()
+    def sub_orgs(self):
+        return to_graph(self.sub_org_triples())
+
+    def unified_org_triples(self):
         addresses = self.addresses()
         for addr in addresses:
             for org in addr["unified_orgs"]:
                 uri = waan_uri(org)
-                r = Resource(g, uri)
-                r.set(RDF.type, WOS.UnifiedOrganization)
-                r.set(RDFS.label, Literal(org))
+                yield (uri, RDF.type, WOS.UnifiedOrganization)
+                yield (uri, RDFS.label, Literal(org))
                 # relation set by address
-        return g
 
-    def addressships(self):
-        g = Graph()
+    def unified_orgs(self):
+        return to_graph(self.unified_org_triples())
+
+    def addressship_triples(self):
         addresses = self.addresses()
         for addr in addresses:
             addr_uri = self.addr_uri(addr["full_address"], addr["number"])
             org = addr["organization"]
-            r = Resource(g, addr_uri)
-            r.set(RDF.type, WOS.Address)
-            r.set(RDFS.label, Literal(addr['full_address']))
-            r.set(WOS.organizationName, Literal(org))
-            r.set(WOS.sequenceNumber, Literal(addr['number']))
+            yield (addr_uri, RDF.type, WOS.Address)
+            yield (addr_uri, RDFS.label, Literal(addr['full_address']))
+            yield (addr_uri, WOS.organizationName, Literal(org))
+            yield (addr_uri, WOS.sequenceNumber, Literal(addr['number']))
             # relation to author set by authorship
             # relate to pub
-            r.set(VIVO.relates, self.uri)
+            yield (addr_uri, VIVO.relates, self.uri)
             # sub orgs
-            for idx, suborg in enumerate(addr["sub_organizations"]):
+            for suborg in addr["sub_organizations"]:
                 label = "{}, {}".format(suborg, org)
                 so_uri = self.sub_org_uri(label)
-                r.add(VIVO.relates, so_uri)
+                yield (addr_uri, VIVO.relates, so_uri)
             # relate unified orgs
             for uorg in addr["unified_orgs"]:
                 uo_uri = waan_uri(uorg)
-                r.add(VIVO.relates, uo_uri)
-        return g
+                yield (addr_uri, VIVO.relates, uo_uri)
 
-    def categories_g(self):
-        g = Graph()
+    def addressships(self):
+        return to_graph(self.addressship_triples())
+
+    def category_triples(self):
         for cat in self.categories():
             cat_uri = get_category_uri(cat)
-            g.add((self.uri, WOS.hasCategory, cat_uri))
-        return g
+            yield (self.uri, WOS.hasCategory, cat_uri)
+
+    def categories_g(self):
+        return to_graph(self.category_triples())
 
     @staticmethod
     def make_date_uri(pub_id, year):
         part = backend.hash_local_name("date", pub_id + year)
         return D[part]
 
-    def add_pub_date(self):
+    def pub_date_triples(self):
         """
         Publication dates in VIVO's expected format.
         """
-        g = Graph()
         value = self.pub_date()
         if value is None:
-            return g
+            return
         date_uri = self.make_date_uri(self.ut, value)
-        date = Resource(g, date_uri)
-        date.set(RDF.type, VIVO.DateTimeValue)
-        date.set(VIVO.dateTimePrecision, VIVO.yearMonthDayPrecision)
-        date.add(
+        yield (date_uri, RDF.type, VIVO.DateTimeValue)
+        yield (date_uri, VIVO.dateTimePrecision, VIVO.yearMonthDayPrecision)
+        yield (
+            date_uri,
             VIVO.dateTime,
             Literal("%sT00:00:00" % (value), datatype=XSD.dateTime)
         )
-        date.add(RDFS.label, Literal(value))
-        date.set(RDF.type, VIVO.DateTimeValue)
-        date.set(VIVO.dateTimePrecision, VIVO.yearMonthDayPrecision)
-        date.add(
-            VIVO.dateTime,
-            Literal("%sT00:00:00" % (value), datatype=XSD.dateTime)
-        )
-        date.add(RDFS.label, Literal(value))
-        g.add((self.uri, VIVO.dateTimeValue, date_uri))
-        return g
+        yield (date_uri, RDFS.label, Literal(value))
+        yield (self.uri, VIVO.dateTimeValue, date_uri)
 
-    def venue(self):
-        g = Graph()
+    def add_pub_date(self):
+        return to_graph(self.pub_date_triples())
+
+    def venue_triples(self):
         source = self.source()
-        # Make uri - hash of source key less unique attributes
+        # Make uri - hash of source key less unique attributes. Built
+        # from the sorted items so it's the same in every process and
+        # run, unlike hash().
         d = source
         d.pop('bid')
         d.pop('ut')
-        uri = D['venue' + str(abs(hash(frozenset(d.items()))))]
+        uri = D[backend.hash_local_name('venue', json.dumps(sorted(d.items())))]
 
         source_type = source['ptype']
         doc_types = self.doc_type()
@@ -598,10 +663,10 @@ class RDFRecord(WosRecord):
             vtype = BIBO.Book
         else:
             raise Exception("Unknown venue type")
-        g.add((uri, RDF.type, vtype))
-        g.add((uri, RDFS.label, Literal(source['title'])))
+        yield (uri, RDF.type, vtype)
+        yield (uri, RDFS.label, Literal(source['title']))
         if source.get('abbrv') is not None:
-            g.add((uri, WOS.journalAbbr, Literal(source['abbrv'])))
+            yield (uri, WOS.journalAbbr, Literal(source['abbrv']))
 
         props = [
             ('issn', BIBO.issn),
@@ -611,23 +676,23 @@ class RDFRecord(WosRecord):
         for k, prop in props:
             val = source.get(k)
             if val is not None:
-                g.add((uri, prop, Literal(val)))
+                yield (uri, prop, Literal(val))
 
         # pub relationship
-        g.add((self.uri, VIVO.hasPublicationVenue, uri))
-        return g
+        yield (self.uri, VIVO.hasPublicationVenue, uri)
 
-    def to(self):
+    def venue(self):
+        return to_graph(self.venue_triples())
+
+    def to_triples(self):
         """
         Core publication metadata mapped to VIVO RDF.
-        :return: Graph
+        :return: generator of triples
         """
-        g = Graph()
-        r = Resource(g, self.uri)
-        r.set(RDFS.label, Literal(self.title()))
+        yield (self.uri, RDFS.label, Literal(self.title()))
         for vtype in self.rec_type():
-            r.add(RDF.type, vtype)
-        r.set(WOS.wosId, Literal(self.ut))
+            yield (self.uri, RDF.type, vtype)
+        yield (self.uri, WOS.wosId, Literal(self.ut))
 
         meta = self.meta()
         # data properties
@@ -648,31 +713,199 @@ class RDFRecord(WosRecord):
         for key, prop in data_props:
             value = meta.get(key)
             if value is not None:
-                g.add((self.uri, prop, Literal(value)))
+                yield (self.uri, prop, Literal(value))
+
+        for triple in self.pub_date_triples():
+            yield triple
+
+    def to(self):
+        """
+        Core publication metadata mapped to VIVO RDF.
+        :return: Graph
+        """
+        return to_graph(self.to_triples())
+
+
+class MetaRecord(RDFRecord):
+
+    """
+    An RDFRecord built from the output of WosRecord.meta() rather than
+    from XML. Used to map records from the parsed record cache without
+    parsing the XML again.
+    """
+
+    def __init__(self, meta):
+        self._meta = meta
+        self.ut = meta['ut']
+
+    def doc_type(self):
+        return self._meta['doc_type']
+
+    def title(self):
+        return self._meta['title']
+
+    def pub_date(self):
+        return self._meta['pub_date']
 
-        g += self.add_pub_date()
+    def pages(self):
+        return self._meta['start'], self._meta['end']
 
-        return g
+    def source(self):
+        # Callers modify the returned dict.
+        return dict(self._meta['source'])
+
+    def keywords_plus(self):
+        return self._meta['keywords_plus']
+
+    def categories(self):
+        return self._meta['categories']
+
+    def author_keywords(self):
+        return self._meta['author_keywords']
+
+    def abstract(self):
+        return self._meta['abstract']
+
+    def get_id(self, id_type):
+        if id_type == "doi":
+            return self._meta['doi']
+        return self._meta['source'].get(id_type)
+
+    def author_list(self):
+        return self._meta['author_list']
+
+    def authors(self):
+        return self._meta['authors']
+
+    def addresses(self):
+        return self._meta['addresses']
+
+    def funding_acknowledgement(self):
+        return self._meta['funding_acknowledgement']
+
+    def grants(self):
+        return self._meta['grants']
+
+    def reference_count(self):
+        return self._meta['reference_count']
+
+    def citation_count(self):
+        return self._meta['citation_count']
+
+    def meta(self):
+        return dict(self._meta)
+
+
+# Prefix of get_data_files entries that point into the segment store.
+SEGMENT_REF = "segment:"
+
+_segment_store = None
+
+
+def get_segment_store():
+    """
+    Segment store for reading, opened once per process.
+    """
+    global _segment_store
+    if _segment_store is None:
+        _segment_store = SegmentStore(SEGMENT_PATH)
+    return _segment_store
+
+
+def segment_ref(seg, offset, length):
+    return "{}{}:{}:{}".format(SEGMENT_REF, seg, offset, length)
+
+
+def read_record(name):
+    """
+    Raw XML for an entry from get_data_files. Records in the segment
+    store are read from the mapped segment without copying.
+    """
+    if name.startswith(SEGMENT_REF):
+        seg, offset, length = name[len(SEGMENT_REF):].split(":")
+        return get_segment_store().read_at(int(seg), int(offset), int(length))
+    with open(name) as inf:
+        return inf.read()
 
 
 def file_path_to_meta(name):
     """
     Take a path to WOS XML doc and convert to record object.
     """
-    with open(name) as inf:
-        raw = inf.read()
-        return RDFRecord(raw)
+    return RDFRecord(read_record(name))
+
+
+_manifest = None
+
+
+def get_manifest():
+    """
+    The corpus manifest, brought up to date once per process. Only
+    shard directories whose mtime changed are rescanned; record files
+    aren't stat'ed.
+    """
+    global _manifest
+    if _manifest is None:
+        _manifest = Manifest(MANIFEST_PATH)
+        scanned = _manifest.refresh_files(RECORD_PATH)
+        added = _manifest.refresh_segments(SEGMENT_PATH, segment_ref)
+        logger.info("Manifest has {} records. Rescanned {} directories, added {} stored records.".format(
+            len(_manifest), scanned, added))
+    return _manifest
 
 
 def get_data_files():
-    return [df for df in glob.glob(RECORD_PATH)]
+    """
+    Record file paths plus references to each record in the segment
+    store, from the corpus manifest.
+    """
+    return get_manifest().paths()
+
+
+def get_dump_files():
+    return [df for df in glob.glob(DUMP_PATH)]
+
+
+def strip_ns(tag):
+    if tag[0] == "{":
+        return tag.split("}", 1)[1]
+    return tag
+
+
+def iter_dump_records(path):
+    """
+    Stream records out of a multi-record WoS XML export, gzipped or not.
+
+    Each REC element is handed to RDFRecord as it is parsed and cleared
+    once the caller asks for the next record, so records should be
+    mapped before moving on. Namespaces are stripped to match the
+    records fetched with lib.wose.
+    """
+    if path.endswith(".gz"):
+        inf = gzip.open(path, 'rb')
+    else:
+        inf = open(path, 'rb')
+    try:
+        # Open elements, so that finished records can be removed from
+        # their parent and memory use stays constant.
+        stack = []
+        for event, elem in ET.iterparse(inf, events=('start', 'end')):
+            if event == 'start':
+                stack.append(elem)
+                continue
+            stack.pop()
+            elem.tag = strip_ns(elem.tag)
+            if elem.tag == 'REC':
+                yield RDFRecord(elem)
+                elem.clear()
+                if stack:
+                    stack[-1].remove(elem)
+    finally:
+        inf.close()
 
 
 def sample_data_files(num):
-    random.seed(SEED)
-    data_files = get_data_files()
-    to_load = [data_files[n] for n in random.sample(xrange(len(data_files)), num)]
-    return to_load
+    return get_manifest().sample(num, SEED)
 
 
 def load_pubs_set(to_load):
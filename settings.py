@@ -8,7 +8,19 @@ NS = {
 }
 
 RECORD_PATH = 'data/pubs/*/*.xml'
+# Multi-record WoS exports, optionally gzipped.
+DUMP_PATH = 'data/dumps/*.xml*'
+# Segment store of harvested records. See lib/segments.py.
+SEGMENT_PATH = 'data/segments/'
+# Manifest of record paths. See lib/manifest.py.
+MANIFEST_PATH = 'data/manifest.db'
 CACHE_PATH = 'data/rdf/'
+# Content-hash caches for incremental mapping. See lib/hashcache.py.
+HASH_CACHE_PATH = 'data/cache/'
+# Local copies of what was last synced to each named graph. See lib/snapshots.py.
+SNAPSHOT_PATH = 'data/snapshots/'
+# Completed update batches, for resuming failed loads. See lib/journal.py.
+JOURNAL_PATH = 'data/journal.db'
 
 PUB_GRAPH = "http://localhost/data/pubs"
 CATEGORY_GRAPH = "http://localhost/data/wos-categories"
@@ -7,44 +7,271 @@ Map WOS XML to RDF for RAP.
 
 import argparse
 import csv
+import functools
+import hashlib
+import json
+import multiprocessing
 import os
 import sys
+import tempfile
+import time
 
 import luigi
+import luigi.format
 from rdflib import Graph, Literal, URIRef
 
 from namespaces import D, WOS, RDFS, RDF, SKOS
-from settings import logger, CACHE_PATH
+from settings import logger, CACHE_PATH, HASH_CACHE_PATH
 
 from lib import backend
+from lib.hashcache import HashCache, content_hash
+from lib.journal import file_hash
+from lib.ntriples import NTriplesSink, nt_line
 
 from publications import (
     RDFRecord,
+    MetaRecord,
     sample_data_files,
     get_data_files,
-    add_author_keyword_data_property,
-    add_keyword_plus_data_property,
+    get_dump_files,
+    iter_dump_records,
+    read_record,
+    author_keyword_data_property_triples,
+    keyword_plus_data_property_triples,
     slug_uri,
-    add_grant
+    grant_triples
 )
 
 from wos_categories import map_categories
 
 
+# Number of items handed to a pool process at a time.
+POOL_CHUNK_SIZE = 50
+
+# Name of the content-hash cache of parsed records. Mapped triples are
+# cached under each task's out_name.
+PARSED_CACHE = "parsed"
+
+# Source files whose code or settings decide what a record parses and
+# maps to. Cache keys include a hash of them and of the data namespace,
+# so changing either makes every stored result a miss.
+MAPPING_SOURCES = (
+    "publications.py",
+    "tasks.py",
+    "namespaces.py",
+    "settings.py",
+    "wos_categories.py",
+    "lib/backend.py",
+    "lib/ntriples.py",
+)
+
+# Outputs written before this are redone by incremental runs. Pool and
+# luigi worker processes are forked, so they share it.
+RUN_STARTED = time.time()
+
+_code_stamp = None
+
+
+def code_stamp():
+    global _code_stamp
+    if _code_stamp is None:
+        base = os.path.dirname(os.path.abspath(__file__))
+        # URIs are minted in D, which comes from DATA_NAMESPACE.
+        parts = [unicode(D).encode('utf-8')]
+        parts.extend(file_hash(os.path.join(base, name)) for name in MAPPING_SOURCES)
+        _code_stamp = content_hash("\n".join(parts))
+    return _code_stamp
+
+
+def record_key(raw):
+    """
+    Cache key for a record: a hash of its content and the mapping code.
+    """
+    h = hashlib.md5(code_stamp())
+    h.update(raw)
+    return h.hexdigest()
+
+
+def incremental_complete(task):
+    """
+    complete() for tasks with an incremental parameter. Luigi skips a
+    task whose output exists, so when incremental only outputs written
+    by this run count. Older ones are redone from the caches.
+    """
+    if task.incremental is False:
+        return luigi.Task.complete(task)
+    for target in luigi.task.flatten(task.output()):
+        if (not target.exists()) or (os.path.getmtime(target.path) < RUN_STARTED):
+            return False
+    return True
+
+
 def get_out_path(name):
     return os.path.join(CACHE_PATH, name)
 
 
-def yield_files(sample):
+def get_file_names(sample):
     if sample == -1:
-        file_names = get_data_files()
+        return get_data_files()
     else:
-        file_names = sample_data_files(sample)
-    for fn in file_names:
-        with open(fn) as inf:
-            raw = inf.read()
-            rec = RDFRecord(raw)
-            yield rec
+        return sample_data_files(sample)
+
+
+def yield_files(sample):
+    for fn in get_file_names(sample):
+        yield RDFRecord(read_record(fn))
+
+
+def cache_line(key, data):
+    """
+    A record cache line: the record's content hash and its meta() JSON.
+    """
+    return "{}\t{}\n".format(key, data)
+
+
+def split_cache_line(line):
+    key, data = line.rstrip("\n").split("\t", 1)
+    return key, data
+
+
+def yield_records(target):
+    """
+    Stream records from the cache written by ParseRecords.
+    """
+    with target.open('r') as inf:
+        for line in inf:
+            key, data = split_cache_line(line)
+            yield MetaRecord(json.loads(data))
+
+
+_hash_caches = {}
+
+
+def get_hash_cache(name):
+    """
+    Content-hash cache opened once per process. Connections aren't
+    shared with forked pool processes.
+    """
+    key = (os.getpid(), name)
+    if key not in _hash_caches:
+        if not os.path.exists(HASH_CACHE_PATH):
+            os.makedirs(HASH_CACHE_PATH)
+        _hash_caches[key] = HashCache(os.path.join(HASH_CACHE_PATH, name + ".db"))
+    return _hash_caches[key]
+
+
+def close_hash_cache(name, prune=False):
+    """
+    Commit and close a cache. With prune set, entries the run didn't
+    use, from deleted or changed records, are removed.
+    """
+    cache = _hash_caches.pop((os.getpid(), name), None)
+    if cache is None:
+        return
+    if prune is True:
+        removed = cache.prune()
+        logger.info("Pruned {} stale entries from the {} cache.".format(removed, name))
+    cache.close()
+
+
+def pool_map(func, items, processes, chunksize=POOL_CHUNK_SIZE):
+    """
+    Apply func to each item using a pool of processes. Results are
+    yielded in input order so output doesn't depend on the pool size.
+    """
+    if processes <= 1:
+        for item in items:
+            yield func(item)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap(func, items, chunksize):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def parse_file(fn, incremental=False):
+    """
+    Parse a record file to its content hash and meta() JSON. When
+    incremental, a record already in the parsed cache isn't parsed and
+    None is returned for the JSON.
+    """
+    raw = read_record(fn)
+    key = record_key(raw)
+    if incremental and (key in get_hash_cache(PARSED_CACHE)):
+        return key, None
+    return key, json.dumps(RDFRecord(raw).meta())
+
+
+def parse_dump(path):
+    """
+    Parse a multi-record export to a temporary file of record cache
+    lines and return the temporary file's path.
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix=".jsonl", dir=CACHE_PATH)
+    done = False
+    try:
+        with os.fdopen(fd, 'w') as out_file:
+            for rec in iter_dump_records(path):
+                data = json.dumps(rec.meta())
+                # The record's XML isn't kept, so hash what was parsed from it.
+                out_file.write(cache_line(record_key(data), data))
+        done = True
+    finally:
+        # Don't leave a partial file behind when parsing fails.
+        if not done:
+            os.remove(tmp_path)
+    return tmp_path
+
+
+def map_cached(task_classes, incremental, line):
+    """
+    Map a line from the record cache with each task class. Returns the
+    record's content hash and a string of N-Triples lines for each
+    task, in the order of task_classes. When incremental and every task
+    has already mapped the record, None is returned for the lines.
+    """
+    key, data = split_cache_line(line)
+    if incremental and all(key in get_hash_cache(task_cls.out_name) for task_cls in task_classes):
+        return key, None
+    rec = MetaRecord(json.loads(data))
+    logger.info("Mapping {} to RDF.".format(rec.ut))
+    return key, [
+        "".join(nt_line(triple) for triple in sorted(set(task_cls.map_record(rec))))
+        for task_cls in task_classes
+    ]
+
+
+def yield_mapped(target, task_classes, processes, incremental=False):
+    """
+    Map every record in the record cache with each task class, yielding
+    a string of N-Triples lines per task for each record. When
+    incremental, records that haven't changed since they were last
+    mapped reuse the stored lines.
+    """
+    if incremental:
+        caches = [get_hash_cache(task_cls.out_name) for task_cls in task_classes]
+    total = 0
+    reused = 0
+    with target.open('r') as inf:
+        func = functools.partial(map_cached, tuple(task_classes), incremental)
+        for key, mapped in pool_map(func, inf, processes):
+            total += 1
+            if incremental:
+                if mapped is None:
+                    mapped = [cache.get(key) for cache in caches]
+                    reused += 1
+                else:
+                    for cache, data in zip(caches, mapped):
+                        cache.put(key, data)
+            yield mapped
+    if incremental:
+        logger.info("Reused stored triples for {} of {} records.".format(reused, total))
 
 
 class Base(luigi.Task):
@@ -56,174 +283,245 @@ class Base(luigi.Task):
 
         # write to file
         with self.output().open('w') as out_file:
-            raw = graph.serialize(format='nt')
-            out_file.write(raw)
-
+            NTriplesSink(out_file).add_all(graph)
 
-class DoPubs(Base):
-    sample = luigi.IntParameter()
-
-    def run(self):
-        g = Graph()
-        for rec in yield_files(self.sample):
-            logger.info("Mapping {} to RDF.".format(rec.ut))
-            g += rec.to()
-
-        self.serialize(g)
 
-    def output(self):
-        path = get_out_path("pubs.nt")
-        return luigi.LocalTarget(path)
+class ParseRecords(luigi.Task):
+    """
+    Parse the WoS XML once and cache each record's meta() as a line of
+    JSON. The mapping tasks stream records from this file rather than
+    each parsing the XML again.
 
+    Multi-record exports in DUMP_PATH are streamed too, but only when
+    mapping everything (sample -1) since they can't be sampled.
 
-class DoVenues(Base):
+    When incremental, records whose content hash is in the parsed cache
+    are copied from it rather than parsed, and an output left by an
+    earlier run is written again.
+    """
     sample = luigi.IntParameter()
+    processes = luigi.IntParameter(default=1, significant=False)
+    incremental = luigi.BoolParameter(default=False, significant=False)
 
     def run(self):
-        g = Graph()
-        for rec in yield_files(self.sample):
-            logger.info("Mapping {} to RDF.".format(rec.ut))
-            g += rec.venue()
-
-        self.serialize(g)
+        file_names = get_file_names(self.sample)
+        if self.sample == -1:
+            dump_names = get_dump_files()
+        else:
+            dump_names = []
+        logger.info("Parsing {} files and {} exports with {} processes.".format(
+            len(file_names), len(dump_names), self.processes))
+        if self.incremental:
+            cache = get_hash_cache(PARSED_CACHE)
+        reused = 0
+        func = functools.partial(parse_file, incremental=self.incremental)
+        with self.output().open('w') as out_file:
+            for key, data in pool_map(func, file_names, self.processes):
+                if self.incremental:
+                    if data is None:
+                        data = cache.get(key)
+                        reused += 1
+                    else:
+                        cache.put(key, data)
+                out_file.write(cache_line(key, data))
+            # One export per pool process at a time.
+            for tmp_path in pool_map(parse_dump, dump_names, self.processes, chunksize=1):
+                with open(tmp_path) as inf:
+                    for line in inf:
+                        out_file.write(line)
+                os.remove(tmp_path)
+        if self.incremental:
+            logger.info("Reused {} of {} parsed records.".format(reused, len(file_names)))
+            close_hash_cache(PARSED_CACHE, prune=(self.sample == -1))
+
+    def complete(self):
+        return incremental_complete(self)
 
     def output(self):
-        path = get_out_path("venues.nt")
-        return luigi.LocalTarget(path)
+        if self.sample == -1:
+            name = "records-all.jsonl.gz"
+        else:
+            name = "records-{}.jsonl.gz".format(self.sample)
+        return luigi.LocalTarget(get_out_path(name), format=luigi.format.Gzip)
 
 
-class DoAuthorship(Base):
-    sample = luigi.IntParameter()
+class RecordTask(Base):
+    """
+    Map each record in the parsed record cache to RDF.
 
-    def run(self):
-        g = Graph()
-        for rec in yield_files(self.sample):
-            logger.info("Mapping {} to RDF.".format(rec.ut))
-            g += rec.authorships()
+    Subclasses set the output file name and implement map_record,
+    which returns an iterable of triples for a record.
 
-        self.serialize(g)
+    When incremental, only new and changed records are mapped. Triples
+    for the rest come from the task's content-hash cache and the output
+    file is written in full, even if one was left by an earlier run.
+    """
+    sample = luigi.IntParameter()
+    processes = luigi.IntParameter(default=1, significant=False)
+    incremental = luigi.BoolParameter(default=False, significant=False)
+    out_name = None
 
-    def output(self):
-        path = get_out_path("authorship.nt")
-        return luigi.LocalTarget(path)
+    def requires(self):
+        return ParseRecords(sample=self.sample, processes=self.processes, incremental=self.incremental)
 
+    @staticmethod
+    def map_record(rec):
+        raise NotImplementedError
 
-class DoAddress(Base):
-    sample = luigi.IntParameter()
+    def complete(self):
+        return incremental_complete(self)
 
     def run(self):
-        g = Graph()
-        for rec in yield_files(self.sample):
-            logger.info("Mapping {} to RDF.".format(rec.ut))
-            g += rec.addressships()
-
-        self.serialize(g)
+        with self.output().open('w') as out_file:
+            sink = NTriplesSink(out_file)
+            for data, in yield_mapped(self.input(), [self.__class__], self.processes, self.incremental):
+                sink.write_lines(data.splitlines(True))
+        if self.incremental:
+            close_hash_cache(self.out_name, prune=(self.sample == -1))
+        logger.info("Wrote {} triples to {}. Skipped {} repeated triples.".format(
+            sink.written, self.out_name, sink.skipped))
 
     def output(self):
-        path = get_out_path("address.nt")
+        path = get_out_path(self.out_name)
         return luigi.LocalTarget(path)
 
 
-class DoSubOrgs(Base):
-    sample = luigi.IntParameter()
+class DoPubs(RecordTask):
+    out_name = "pubs.nt"
 
-    def run(self):
-        g = Graph()
-        for rec in yield_files(self.sample):
-            logger.info("Mapping {} to RDF.".format(rec.ut))
-            g += rec.sub_orgs()
+    @staticmethod
+    def map_record(rec):
+        return rec.to_triples()
 
-        self.serialize(g)
 
-    def output(self):
-        path = get_out_path("suborgs.nt")
-        return luigi.LocalTarget(path)
+class DoVenues(RecordTask):
+    out_name = "venues.nt"
 
+    @staticmethod
+    def map_record(rec):
+        return rec.venue_triples()
 
-class DoUnifiedOrgs(Base):
-    sample = luigi.IntParameter()
 
-    def run(self):
-        g = Graph()
-        for rec in yield_files(self.sample):
-            logger.info("Mapping {} to RDF.".format(rec.ut))
-            g += rec.unified_orgs()
+class DoAuthorship(RecordTask):
+    out_name = "authorship.nt"
 
-        self.serialize(g)
+    @staticmethod
+    def map_record(rec):
+        return rec.authorship_triples()
 
-    def output(self):
-        path = get_out_path("unified-orgs.nt")
-        return luigi.LocalTarget(path)
 
+class DoAddress(RecordTask):
+    out_name = "address.nt"
 
-class DoCategories(Base):
-    sample = luigi.IntParameter()
+    @staticmethod
+    def map_record(rec):
+        return rec.addressship_triples()
 
-    def run(self):
-        g = Graph()
-        for rec in yield_files(self.sample):
-            logger.info("Mapping {} to RDF.".format(rec.ut))
-            g += rec.categories_g()
 
-        self.serialize(g)
+class DoSubOrgs(RecordTask):
+    out_name = "suborgs.nt"
 
-    def output(self):
-        path = get_out_path("categories-pubs.nt")
-        return luigi.LocalTarget(path)
+    @staticmethod
+    def map_record(rec):
+        return rec.sub_org_triples()
 
 
-class KeywordsPlus(Base):
+class DoUnifiedOrgs(RecordTask):
+    out_name = "unified-orgs.nt"
 
-    sample = luigi.IntParameter()
+    @staticmethod
+    def map_record(rec):
+        return rec.unified_org_triples()
 
-    def run(self):
-        kwp_g = Graph()
-        logger.info("Indexing publication keywords")
-        for rec in yield_files(self.sample):
-            for kwp in rec.keywords_plus():
-                kwp_g += add_keyword_plus_data_property(kwp, rec.uri)
 
-        self.serialize(kwp_g)
+class DoCategories(RecordTask):
+    out_name = "categories-pubs.nt"
 
-    def output(self):
-        path = get_out_path("keywords-plus.nt")
-        return luigi.LocalTarget(path)
+    @staticmethod
+    def map_record(rec):
+        return rec.category_triples()
 
 
-class AuthorKeywords(Base):
+class KeywordsPlus(RecordTask):
+    out_name = "keywords-plus.nt"
 
-    sample = luigi.IntParameter()
+    @staticmethod
+    def map_record(rec):
+        for kwp in rec.keywords_plus():
+            for triple in keyword_plus_data_property_triples(kwp, rec.uri):
+                yield triple
 
-    def run(self):
-        outg = Graph()
-        logger.info("Indexing publication keywords")
-        for rec in yield_files(self.sample):
-            for kw in rec.author_keywords():
-                outg += add_author_keyword_data_property(kw, rec.uri)
 
-        self.serialize(outg)
+class AuthorKeywords(RecordTask):
+    out_name = "author-keywords.nt"
 
-    def output(self):
-        path = get_out_path("author-keywords.nt")
-        return luigi.LocalTarget(path)
+    @staticmethod
+    def map_record(rec):
+        for kw in rec.author_keywords():
+            for triple in author_keyword_data_property_triples(kw, rec.uri):
+                yield triple
 
 
-class Grants(Base):
+class Grants(RecordTask):
+    out_name = "grants.nt"
 
+    @staticmethod
+    def map_record(rec):
+        for grant in rec.grants():
+            for triple in grant_triples(grant, rec.uri):
+                yield triple
+
+
+# Per-record mapping tasks run by DoPubProcess.
+RECORD_TASKS = [
+    DoPubs,
+    DoVenues,
+    DoAuthorship,
+    DoAddress,
+    DoSubOrgs,
+    Grants,
+    DoUnifiedOrgs,
+    DoCategories,
+    KeywordsPlus,
+    AuthorKeywords,
+]
+
+
+class FusedRecordTasks(luigi.Task):
+    """
+    Run all of the RECORD_TASKS mappings in a single pass over the
+    records. Each record's triples are written to the same files the
+    individual tasks write as soon as the record is mapped.
+    """
     sample = luigi.IntParameter()
+    processes = luigi.IntParameter(default=1, significant=False)
+    incremental = luigi.BoolParameter(default=False, significant=False)
 
-    def run(self):
-        g = Graph()
-        logger.info("Indexing grants")
-        for rec in yield_files(self.sample):
-            for grant in rec.grants():
-                g += add_grant(grant, rec.uri)
+    def requires(self):
+        return ParseRecords(sample=self.sample, processes=self.processes, incremental=self.incremental)
 
-        self.serialize(g)
+    def run(self):
+        outputs = self.output()
+        out_files = dict((name, outputs[name].open('w')) for name in outputs)
+        sinks = dict((name, NTriplesSink(out_files[name])) for name in outputs)
+        for mapped in yield_mapped(self.input(), RECORD_TASKS, self.processes, self.incremental):
+            for task_cls, data in zip(RECORD_TASKS, mapped):
+                sinks[task_cls.out_name].write_lines(data.splitlines(True))
+        # Only move complete files into place.
+        for out_file in out_files.values():
+            out_file.close()
+        if self.incremental:
+            for task_cls in RECORD_TASKS:
+                close_hash_cache(task_cls.out_name, prune=(self.sample == -1))
+
+    def complete(self):
+        return incremental_complete(self)
 
     def output(self):
-        path = get_out_path("grants.nt")
-        return luigi.LocalTarget(path)
+        return dict(
+            (task_cls.out_name, luigi.LocalTarget(get_out_path(task_cls.out_name)))
+            for task_cls in RECORD_TASKS
+        )
 
 
 class MapCategoryTree(Base):
@@ -283,18 +581,20 @@ class MapCategoryTree(Base):
 
 class DoPubProcess(luigi.Task):
     sample = luigi.IntParameter()
+    # Map all record outputs in one pass rather than one task each.
+    fused = luigi.BoolParameter(default=False)
+    # Size of the process pool each task maps records with.
+    processes = luigi.IntParameter(default=1, significant=False)
+    # Only map records that are new or changed since the last run.
+    incremental = luigi.BoolParameter(default=False, significant=False)
 
     def requires(self):
-        yield DoPubs(sample=self.sample)
-        yield DoVenues(sample=self.sample)
-        yield DoAuthorship(sample=self.sample)
-        yield DoAddress(sample=self.sample)
-        yield DoSubOrgs(sample=self.sample)
-        yield Grants(sample=self.sample)
-        yield DoUnifiedOrgs(sample=self.sample)
-        yield DoCategories(sample=self.sample)
-        yield KeywordsPlus(sample=self.sample)
-        yield AuthorKeywords(sample=self.sample)
+        params = dict(sample=self.sample, processes=self.processes, incremental=self.incremental)
+        if self.fused is True:
+            yield FusedRecordTasks(**params)
+        else:
+            for task_cls in RECORD_TASKS:
+                yield task_cls(**params)
         yield MapCategoryTree()
 
 if __name__ == '__main__':
@@ -303,9 +603,20 @@ if __name__ == '__main__':
     parser.add_argument('--sample', '-s', default=500, type=int, help="Sample size")
     parser.add_argument('--local', '-l', default=False, action="store_true", help="Use local scheduler")
     parser.add_argument('--workers', '-w', default=3, help="luigi workers")
+    parser.add_argument('--fused', '-f', default=False, action="store_true", help="Map all record outputs in a single pass")
+    parser.add_argument('--processes', '-p', default=1, type=int, help="Processes used to map records within a task")
+    parser.add_argument('--incremental', '-i', default=False, action="store_true", help="Reuse triples for unchanged records")
     args = parser.parse_args(sys.argv[1:])
 
-    params = ["--sample={}".format(args.sample), "--workers={}".format(args.workers)]
+    params = [
+        "--sample={}".format(args.sample),
+        "--workers={}".format(args.workers),
+        "--processes={}".format(args.processes)
+    ]
+    if args.fused is True:
+        params.append("--fused")
+    if args.incremental is True:
+        params.append("--incremental")
     if args.local is True:
         params.append("--local-scheduler")
     luigi.run(params, main_task_cls=DoPubProcess)
@@ -0,0 +1,350 @@
+"""
+Backend update helper tests
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from rdflib import Graph, Literal, URIRef
+
+from utils import StubStore
+
+from lib import backend
+
+
+class HTTPError(Exception):
+
+    def __init__(self, code, body=""):
+        Exception.__init__(self, "HTTP Error {}".format(code))
+        self.code = code
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class TestTransient(unittest.TestCase):
+
+    def test_codes(self):
+        self.assertTrue(backend.is_transient(HTTPError(503)))
+        self.assertTrue(backend.is_transient(HTTPError(429)))
+        self.assertFalse(backend.is_transient(HTTPError(400)))
+        self.assertTrue(backend.is_transient(IOError("connection reset")))
+
+    def test_forbidden(self):
+        # Refused access isn't retried, a 403 from an overloaded VIVO is.
+        self.assertFalse(backend.is_transient(HTTPError(403, "Not authorized to edit")))
+        self.assertTrue(backend.is_transient(HTTPError(403, "Too many requests, try again later")))
+
+
+class TestBatchController(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = backend.BatchController(size=1000, min_size=100, max_size=2000, target=10.0, max_pause=60.0)
+
+    def test_grows_when_fast(self):
+        self.controller.succeeded(1.0)
+        self.assertEqual(self.controller.size, 1100)
+        self.assertEqual(self.controller.pause, 0.0)
+
+    def test_shrinks_when_slow(self):
+        self.controller.succeeded(20.0)
+        self.assertEqual(self.controller.size, 500)
+        self.assertEqual(self.controller.pause, 10.0)
+        # The pause eases off while updates keep up.
+        self.controller.succeeded(1.0)
+        self.assertEqual(self.controller.pause, 5.0)
+
+    def test_failed(self):
+        self.controller.failed()
+        self.assertEqual(self.controller.size, 500)
+        self.assertEqual(self.controller.pause, 1.0)
+        self.controller.failed()
+        self.assertEqual(self.controller.size, 250)
+        self.assertEqual(self.controller.pause, 2.0)
+
+    def test_limits(self):
+        for num in range(20):
+            self.controller.failed()
+        self.assertEqual(self.controller.size, 100)
+        self.assertEqual(self.controller.pause, 60.0)
+        for num in range(30):
+            self.controller.succeeded(0.1)
+        self.assertEqual(self.controller.size, 2000)
+        self.controller.seed(10)
+        self.assertEqual(self.controller.size, 100)
+        self.controller.seed(100000)
+        self.assertEqual(self.controller.size, 2000)
+
+
+class TestPlanLoad(unittest.TestCase):
+
+    named_graph = "http://localhost/data/pubs"
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = StubStore(os.path.join(self.path, "snapshots"))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def fill(self, num):
+        self.store.graphs[self.named_graph] = set(
+            "<http://localhost/s{}> <http://localhost/p> \"o\" .\n".format(i) for i in range(num)
+        )
+
+    def test_empty_graph(self):
+        plan = self.store.plan_load(self.named_graph)
+        self.assertEqual(plan.strategy, backend.BLIND_INSERT)
+
+    def test_full_diff(self):
+        self.fill(100)
+        plan = self.store.plan_load(self.named_graph, incoming=100, subjects=range(100))
+        self.assertEqual(plan.strategy, backend.FULL_DIFF)
+        self.assertFalse(plan.snapshot)
+
+    def test_subject_diff(self):
+        # A few subjects against a large graph, when not syncing.
+        self.fill(20000)
+        plan = self.store.plan_load(self.named_graph, incoming=10, subjects=range(5), sync=False)
+        self.assertEqual(plan.strategy, backend.SUBJECT_DIFF)
+        # A sync has to see the whole graph.
+        plan = self.store.plan_load(self.named_graph, incoming=10, subjects=range(5), sync=True)
+        self.assertEqual(plan.strategy, backend.FULL_DIFF)
+
+    def test_snapshot(self):
+        self.fill(20000)
+        self.store.snapshots.save_lines(self.named_graph, sorted(self.store.graphs[self.named_graph]))
+        plan = self.store.plan_load(self.named_graph, incoming=10, subjects=range(5), sync=False)
+        self.assertTrue(plan.snapshot)
+        self.assertEqual(plan.strategy, backend.FULL_DIFF)
+        self.assertEqual(plan.costs[backend.FULL_DIFF], int(20000 * backend.SNAPSHOT_READ_COST))
+        # A changed count means the snapshot can't be trusted.
+        self.fill(20001)
+        self.assertFalse(self.store.plan_load(self.named_graph).snapshot)
+
+
+class TestPostBatches(unittest.TestCase):
+
+    named_graph = "http://localhost/data/pubs"
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = StubStore(os.path.join(self.path, "snapshots"))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_utf8_lines(self):
+        # Valid N-Triples 1.1 may hold UTF-8 rather than escapes.
+        lines = [
+            "<http://localhost/s1> <http://localhost/p> \"caf\xc3\xa9\" .\n",
+            u"<http://localhost/s2> <http://localhost/p> \"plain\" .\n",
+        ]
+        self.assertEqual(self.store.post_batches(self.named_graph, lines), 2)
+        self.assertEqual(
+            self.store.graphs[self.named_graph],
+            set(line.decode('utf-8') if isinstance(line, str) else line for line in lines)
+        )
+
+
+class KeyStore(backend.SyncVStore):
+    """
+    Answers page_keys queries from a list of keys and records them.
+    """
+
+    def __init__(self, keys):
+        self.keys = sorted(keys)
+        self.queries = []
+
+    def query(self, q):
+        self.queries.append(q)
+        size = int(re.search(r"LIMIT (\d+)", q).group(1))
+        after = re.search(r'FILTER \(STR\(\?s\) > "([^"]*)"\)', q)
+        keys = [k for k in self.keys if after is None or unicode(k) > after.group(1)]
+        return [(k,) for k in keys[:size]]
+
+
+class TestPageKeys(unittest.TestCase):
+
+    def keys(self, num):
+        return [URIRef("http://localhost/s{:03d}".format(i)) for i in range(num)]
+
+    def test_pages(self):
+        vstore = KeyStore(self.keys(7))
+        pages = list(vstore.page_keys("?s ?p ?o", "s", size=3))
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual(sum(pages, []), self.keys(7))
+        self.assertEqual(len(vstore.queries), 3)
+        # The first page has no filter, later ones start after the
+        # last key of the previous page.
+        self.assertNotIn("FILTER", vstore.queries[0])
+        self.assertIn('> "http://localhost/s002"', vstore.queries[1])
+        self.assertIn('> "http://localhost/s005"', vstore.queries[2])
+
+    def test_full_last_page(self):
+        vstore = KeyStore(self.keys(6))
+        pages = list(vstore.page_keys("?s ?p ?o", "s", size=3))
+        self.assertEqual(sum(pages, []), self.keys(6))
+        # One more query finds the end.
+        self.assertEqual(len(vstore.queries), 3)
+
+    def test_empty(self):
+        vstore = KeyStore([])
+        self.assertEqual(list(vstore.page_keys("?s ?p ?o", "s")), [])
+        self.assertEqual(len(vstore.queries), 1)
+
+
+class Result(object):
+
+    def __init__(self, graph):
+        self.graph = graph
+
+
+class BucketStore(backend.SyncVStore):
+    """
+    Answers CONSTRUCT queries from a list of triples and records them.
+    """
+
+    def __init__(self, triples):
+        self.triples = triples
+        self.queries = []
+
+    def query(self, q):
+        self.queries.append(q)
+        bucket = re.search(r'STRSTARTS\(MD5\(STR\(\?s\)\), "([0-9a-f]+)"\)', q).group(1)
+        g = Graph()
+        for triple in self.triples:
+            if hashlib.md5(unicode(triple[0]).encode('utf-8')).hexdigest().startswith(bucket):
+                g.add(triple)
+        return Result(g)
+
+
+class TestIterExisting(unittest.TestCase):
+
+    named_graph = "http://localhost/data/pubs"
+
+    def triples(self, num):
+        p = URIRef("http://localhost/p")
+        return [(URIRef("http://localhost/s{}".format(i)), p, Literal(i)) for i in range(num)]
+
+    def test_small_graph(self):
+        vstore = KeyStore([])
+        self.assertEqual(list(vstore.iter_existing(self.named_graph, count=10)), [])
+        self.assertIn("ORDER BY", vstore.queries[0])
+
+    def test_hash_buckets(self):
+        triples = self.triples(100)
+        vstore = BucketStore(triples)
+        found = list(vstore.iter_existing(self.named_graph, count=backend.KEYSET_MAX_TRIPLES + 1))
+        self.assertEqual(len(vstore.queries), 16)
+        # Every triple comes from exactly one bucket.
+        self.assertEqual(sorted(found), sorted(triples))
+        vstore = BucketStore(triples)
+        list(vstore.iter_existing(self.named_graph, count=16 * backend.BUCKET_TRIPLES + 1))
+        self.assertEqual(len(vstore.queries), 256)
+        self.assertNotIn("ORDER BY", vstore.queries[0])
+
+
+class FakeStore(object):
+    """
+    Records how many stores are in use at once.
+    """
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+
+    def __init__(self):
+        self.label = "store"
+
+    def _enter(self):
+        with FakeStore.lock:
+            FakeStore.active += 1
+            FakeStore.max_active = max(FakeStore.max_active, FakeStore.active)
+
+    def _exit(self):
+        with FakeStore.lock:
+            FakeStore.active -= 1
+
+    def query(self, q):
+        time.sleep(0.005)
+        return self
+
+    def cursor_select(self, variables, where):
+        self._enter()
+        try:
+            for num in range(3):
+                yield self, num
+        finally:
+            self._exit()
+
+
+class TestStorePool(unittest.TestCase):
+
+    def setUp(self):
+        FakeStore.active = 0
+        FakeStore.max_active = 0
+        self.made = []
+
+    def factory(self):
+        vstore = FakeStore()
+        self.made.append(vstore)
+        return vstore
+
+    def assertAllReturned(self, pool):
+        self.assertEqual(pool._held, {})
+        for num in range(pool.size):
+            self.assertTrue(pool._slots.acquire(False))
+
+    def test_threads(self):
+        pool = backend.StorePool(self.factory, size=3)
+        mismatched = []
+
+        def work():
+            for num in range(5):
+                for vstore, item in pool.cursor_select(["s"], "?s ?p ?o"):
+                    # Queries inside the cursor loop reuse its store.
+                    if pool.query("ASK {}") is not vstore:
+                        mismatched.append(vstore)
+
+        threads = [threading.Thread(target=work) for num in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(mismatched, [])
+        self.assertTrue(len(self.made) <= 3)
+        self.assertTrue(FakeStore.max_active <= 3)
+        self.assertAllReturned(pool)
+
+    def test_other_thread_finishes(self):
+        pool = backend.StorePool(self.factory, size=2)
+        cursor = pool.cursor_select(["s"], "?s ?p ?o")
+        next(cursor)
+        done = threading.Thread(target=lambda: list(cursor))
+        done.start()
+        done.join()
+        self.assertAllReturned(pool)
+
+    def test_plain_attribute(self):
+        pool = backend.StorePool(self.factory, size=1)
+        cursor = pool.cursor_select(["s"], "?s ?p ?o")
+        next(cursor)
+        # The only store is held, but another thread can still read
+        # its attributes.
+        labels = []
+        reader = threading.Thread(target=lambda: labels.append(pool.label))
+        reader.start()
+        reader.join(2)
+        self.assertEqual(labels, ["store"])
+        list(cursor)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""
+Ground graph diff tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from rdflib import BNode, Graph, Literal, URIRef
+from rdflib.compare import graph_diff
+
+from lib.graphdiff import ADD, DELETE, diff_graphs, diff_nt_files, merge_diff, sorted_lines, write_nt
+
+
+def ex(name):
+    return URIRef("http://x.org/" + name)
+
+
+class TestGraphDiff(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.incoming = Graph()
+        self.existing = Graph()
+        for i in range(20):
+            self.incoming.add((ex("s{}".format(i)), ex("p"), Literal(i)))
+            self.existing.add((ex("s{}".format(i + 5)), ex("p"), Literal(i + 5)))
+        self.incoming.add((ex("s1"), ex("label"), Literal(u"caf\xe9")))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_same_as_graph_diff(self):
+        both, adds, deletes = graph_diff(self.incoming, self.existing)
+        fast_adds, fast_deletes = diff_graphs(self.incoming, self.existing)
+        self.assertEqual(set(fast_adds), set(adds))
+        self.assertEqual(set(fast_deletes), set(deletes))
+
+    def test_bnodes_fall_back(self):
+        self.incoming.add((ex("s1"), ex("q"), BNode()))
+        adds, deletes = diff_graphs(self.incoming, self.existing)
+        self.assertEqual(len(adds), 7)
+        self.assertEqual(len(deletes), 5)
+
+    def test_sorted_lines_on_disk(self):
+        lines = ["{}\n".format(i) for i in [5, 3, 9, 3, 1, 7, 5, 2]]
+        self.assertEqual(list(sorted_lines(lines, chunk_size=3)), sorted(set(lines)))
+
+    def test_sorted_lines_duplicate_first_chunk(self):
+        # A duplicate shrinks the first chunk, but more lines follow.
+        lines = ["a\n", "a\n", "b\n", "c\n"]
+        self.assertEqual(list(sorted_lines(lines, chunk_size=2)), ["a\n", "b\n", "c\n"])
+        ops = list(merge_diff(sorted_lines(lines, chunk_size=2), ["a\n", "b\n", "c\n"]))
+        self.assertEqual(ops, [])
+
+    def test_diff_nt_files(self):
+        incoming_path = os.path.join(self.path, "incoming.nt")
+        existing_path = os.path.join(self.path, "existing.nt")
+        write_nt(self.incoming, incoming_path)
+        self.existing.serialize(existing_path, format="nt")
+        adds, deletes = diff_graphs(self.incoming, self.existing)
+        ops = list(diff_nt_files(incoming_path, existing_path, chunk_size=4))
+        add_g = Graph().parse(data="".join(line for op, line in ops if op == ADD), format="nt")
+        delete_g = Graph().parse(data="".join(line for op, line in ops if op == DELETE), format="nt")
+        self.assertEqual(set(add_g), set(adds))
+        self.assertEqual(set(delete_g), set(deletes))
+
+if __name__ == '__main__':
+    unittest.main()
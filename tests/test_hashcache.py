@@ -0,0 +1,40 @@
+"""
+Content-hash cache tests
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from lib.hashcache import HashCache, content_hash
+
+
+class TestHashCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.path, "cache.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_reuse_and_prune(self):
+        one = content_hash("<REC>one</REC>")
+        two = content_hash("<REC>two</REC>")
+        cache = HashCache(self.db_path)
+        cache.put(one, "a")
+        cache.put(two, "b")
+        cache.close()
+        time.sleep(0.01)
+
+        cache = HashCache(self.db_path)
+        self.assertTrue(one in cache)
+        self.assertFalse(content_hash("<REC>one changed</REC>") in cache)
+        self.assertEqual(cache.get(one), "a")
+        # Only the entry used in this run survives.
+        self.assertEqual(cache.prune(), 1)
+        self.assertFalse(two in cache)
+        self.assertEqual(cache.get(one), "a")
+        cache.close()
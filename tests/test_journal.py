@@ -0,0 +1,55 @@
+"""
+Batch journal tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.journal import BatchJournal, load_key
+
+
+class TestBatchJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_resume_offset(self):
+        db_path = os.path.join(self.path, "journal.db")
+        key = load_key("abc", "http://localhost/data/pubs", "add")
+        journal = BatchJournal(db_path)
+        self.assertEqual(journal.resume_offset(key), 0)
+        journal.record(key, 0, 100)
+        journal.record(key, 100, 50)
+        # Batches after a gap aren't resumed from.
+        journal.record(key, 200, 50)
+        journal.close()
+
+        journal = BatchJournal(db_path)
+        self.assertEqual(journal.resume_offset(key), 150)
+        self.assertEqual(journal.resume_offset(load_key("abc", "http://localhost/data/pubs", "remove")), 0)
+        journal.finish(key)
+        self.assertEqual(journal.resume_offset(key), 0)
+
+    def test_prune(self):
+        journal = BatchJournal(os.path.join(self.path, "journal.db"))
+        old = load_key("abc", "http://localhost/data/pubs", "add")
+        new = load_key("def", "http://localhost/data/pubs", "add")
+        other = load_key("abc", "http://localhost/data/venues", "add")
+        for key in (old, new, other):
+            journal.record(key, 0, 100)
+        journal.conn.execute("UPDATE batches SET recorded = 0 WHERE load_key = ?", (other,))
+        self.assertEqual(journal.prune(60), 1)
+        self.assertEqual(journal.resume_offset(other), 0)
+        # A load of new content replaces the old one to the same graph.
+        self.assertEqual(journal.supersede(new), 1)
+        self.assertEqual(journal.resume_offset(old), 0)
+        self.assertEqual(journal.resume_offset(new), 100)
+        journal.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+"""
+Corpus manifest tests
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from lib.manifest import Manifest
+from lib.segments import SegmentStore
+
+
+def make_ref(seg, offset, length):
+    return "segment:{}:{}:{}".format(seg, offset, length)
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.pattern = os.path.join(self.path, "pubs", "*", "*.xml")
+        for shard, uts in (("00", ["001", "002"]), ("01", ["011"])):
+            os.makedirs(os.path.join(self.path, "pubs", shard))
+            for ut in uts:
+                self.write(shard, ut)
+        self.manifest = Manifest(os.path.join(self.path, "manifest.db"))
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.path)
+
+    def write(self, shard, ut):
+        with open(os.path.join(self.path, "pubs", shard, ut + ".xml"), "w") as outf:
+            outf.write("<REC/>")
+
+    def test_refresh_files(self):
+        self.assertEqual(self.manifest.refresh_files(self.pattern), 2)
+        self.assertEqual(len(self.manifest), 3)
+        # Nothing changed, nothing rescanned.
+        self.assertEqual(self.manifest.refresh_files(self.pattern), 0)
+        # Make sure the directory mtime moves.
+        time.sleep(0.01)
+        self.write("01", "012")
+        os.remove(os.path.join(self.path, "pubs", "00", "001.xml"))
+        self.assertEqual(self.manifest.refresh_files(self.pattern), 2)
+        uts = sorted(row[0] for row in self.manifest.conn.execute("SELECT ut FROM records"))
+        self.assertEqual(uts, ["WOS:002", "WOS:011", "WOS:012"])
+
+    def test_rewritten_file(self):
+        self.manifest.refresh_files(self.pattern)
+        fn = os.path.join(self.path, "pubs", "00", "001.xml")
+        # Rewriting a file leaves its directory's mtime alone.
+        with open(fn, "w") as outf:
+            outf.write("<REC>rewritten</REC>")
+        self.manifest.refresh_files(self.pattern)
+        size = "SELECT size FROM records WHERE path = ?"
+        self.assertEqual(self.manifest.conn.execute(size, (fn,)).fetchone()[0], 6)
+        self.assertEqual(self.manifest.refresh_files(self.pattern, check_files=True), 0)
+        self.assertEqual(self.manifest.conn.execute(size, (fn,)).fetchone()[0], 20)
+
+    def test_refresh_segments(self):
+        store_path = os.path.join(self.path, "segments")
+        store = SegmentStore(store_path)
+        store.put("WOS:100", "<REC/>")
+        store.flush()
+        self.assertEqual(self.manifest.refresh_segments(store_path, make_ref), 1)
+        store.put("WOS:100", "<REC>new</REC>")
+        store.close()
+        self.assertEqual(self.manifest.refresh_segments(store_path, make_ref), 1)
+        self.assertEqual(self.manifest.paths(), [make_ref(*store.index["WOS:100"])])
+
+    def test_sample(self):
+        self.manifest.refresh_files(self.pattern)
+        first = self.manifest.sample(2, 71)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(self.manifest.sample(2, 71), first)
+
+if __name__ == '__main__':
+    unittest.main()
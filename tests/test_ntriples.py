@@ -0,0 +1,32 @@
+"""
+N-Triples writer tests
+"""
+
+from StringIO import StringIO
+import unittest
+
+from rdflib import Graph, Literal, URIRef
+
+from lib.ntriples import NTriplesSink, nt_line
+
+
+class TestNTriples(unittest.TestCase):
+
+    def test_nt_line(self):
+        g = Graph()
+        g.add((URIRef("http://x.org/a"), URIRef("http://x.org/p"), Literal(u"caf\xe9 \"q\"\n")))
+        triple = list(g)[0]
+        self.assertEqual(nt_line(triple), g.serialize(format='nt').strip() + "\n")
+
+    def test_sink_window(self):
+        out = StringIO()
+        sink = NTriplesSink(out, window=2)
+        for line in ["a .\n", "b .\n", "a .\n", "c .\n", "d .\n", "a .\n"]:
+            sink.write_line(line)
+        # "a" is forgotten once two other lines have been seen since.
+        self.assertEqual(out.getvalue(), "a .\nb .\nc .\nd .\na .\n")
+        self.assertEqual(sink.written, 5)
+        self.assertEqual(sink.skipped, 1)
+
+if __name__ == '__main__':
+    unittest.main()
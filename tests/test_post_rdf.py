@@ -0,0 +1,85 @@
+"""
+Prepare and post pipeline tests against a stub store
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from utils import StubStore, drop_store, use_store
+
+from lib import backend
+import post_rdf
+
+PUBS = post_rdf.NG_BASE + "pubs"
+VENUES = post_rdf.NG_BASE + "venues"
+
+
+def line(num):
+    return "<http://localhost/individual/s{0}> <http://localhost/p> \"{0}\" .\n".format(num)
+
+
+class TestPostRdf(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = StubStore(os.path.join(self.path, "snapshots"))
+        use_store(self.store)
+        self.journal_path = backend.JOURNAL_PATH
+        backend.JOURNAL_PATH = os.path.join(self.path, "journal.db")
+        backend._journals.clear()
+
+    def tearDown(self):
+        drop_store()
+        for journal in backend._journals.values():
+            journal.close()
+        backend._journals.clear()
+        backend.JOURNAL_PATH = self.journal_path
+        shutil.rmtree(self.path)
+
+    def write(self, subdir, name, nums):
+        path = os.path.join(self.path, subdir)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        fpath = os.path.join(path, name)
+        with open(fpath, 'w') as outf:
+            outf.writelines(line(num) for num in nums)
+        return fpath
+
+    def test_order(self):
+        files = [
+            self.write("one", "pubs.nt", [1, 2]),
+            self.write("one", "venues.nt", [10]),
+            # A later file for the same graph is diffed against what
+            # the first one posted.
+            self.write("two", "pubs.nt", [2, 3]),
+        ]
+        post_rdf.process(files, sync=True, ahead=2)
+        self.assertEqual(self.store.graphs[PUBS], set([line(2), line(3)]))
+        self.assertEqual(self.store.graphs[VENUES], set([line(10)]))
+        self.assertEqual(self.store.updates, [
+            ("INSERT", PUBS, 2),
+            ("INSERT", VENUES, 1),
+            ("INSERT", PUBS, 1),
+            ("DELETE", PUBS, 1),
+        ])
+
+    def test_prepare_error(self):
+        files = [
+            self.write("one", "pubs.nt", [1]),
+            os.path.join(self.path, "missing.nt"),
+            self.write("one", "venues.nt", [10]),
+        ]
+        self.assertRaises(IOError, post_rdf.process, files, ahead=2)
+        # Files before the failure are posted, later ones aren't.
+        self.assertEqual(self.store.graphs, {PUBS: set([line(1)])})
+
+    def test_dry_run(self):
+        self.store.graphs[PUBS] = set([line(1)])
+        post_rdf.process([self.write("one", "pubs.nt", [1, 2])], dry=True, sync=True)
+        self.assertEqual(self.store.reads, 0)
+        self.assertEqual(self.store.updates, [])
+
+if __name__ == '__main__':
+    unittest.main()
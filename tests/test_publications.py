@@ -2,11 +2,31 @@
 Publications parsing tests
 """
 
+import gzip
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
 from utils import read_file
 
-from publications import WosRecord
+from rdflib import Graph, Literal
+
+from publications import (
+    WosRecord,
+    RDFRecord,
+    MetaRecord,
+    iter_dump_records,
+    to_graph,
+    category_triples,
+    keyword_plus_triples,
+    grant_triples,
+    get_category_uri,
+    keyword_plus_uri,
+    waan_uri
+)
+from namespaces import D, BIBO, WOS, RDF, RDFS, VIVO
 import settings
 
 
@@ -27,5 +47,154 @@ class TestPublications(unittest.TestCase):
         first_addr = addrs[0]
         self.assertEqual(first_addr['sub_organizations'][0], settings.DEPARTMENT_UNKNOWN_LABEL)
 
+    def test_address_index(self):
+        rec = RDFRecord(read_file('data/test_rec_full.xml'))
+        self.assertIs(rec.addresses(), rec.addresses())
+        index = rec.address_index()
+        self.assertEqual(sorted(index.keys()), ['1', '2'])
+        self.assertEqual(index['2'][0]['organization'], 'Syracuse Univ')
+        uris = rec.addr_uris_from_number('2')
+        self.assertEqual(uris, [rec.addr_uri('Syracuse Univ, Syracuse, NY 13244 USA', '2')])
+        self.assertEqual(rec.addr_uris_from_number('3'), [])
+
+    def test_meta_record(self):
+        rec = RDFRecord(read_file('data/test_rec_full.xml'))
+        cached = MetaRecord(json.loads(json.dumps(rec.meta())))
+        for method in ('to', 'venue', 'authorships', 'addressships', 'sub_orgs', 'unified_orgs', 'categories_g'):
+            self.assertEqual(
+                set(getattr(rec, method)()),
+                set(getattr(cached, method)()),
+                method
+            )
+
+    def test_dump_records(self):
+        raw = read_file('data/test_rec_full.xml')
+        dump = '<records xmlns="http://clarivate.com/schema/wok5.30/public/FullRecord">{}{}</records>'.format(
+            raw,
+            raw.replace('WOS:000456', 'WOS:000457')
+        )
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            plain = os.path.join(tmp_dir, 'dump.xml')
+            with open(plain, 'w') as outf:
+                outf.write(dump)
+            zipped = os.path.join(tmp_dir, 'dump.xml.gz')
+            with gzip.open(zipped, 'wb') as outf:
+                outf.write(dump)
+            for path in (plain, zipped):
+                uts = []
+                for rec in iter_dump_records(path):
+                    uts.append(rec.ut)
+                    self.assertEqual(rec.title(), 'Mapping test records to RDF')
+                    self.assertEqual(len(rec.addresses()), 2)
+                self.assertEqual(uts, ['WOS:000456', 'WOS:000457'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+
+class TestTriples(unittest.TestCase):
+
+    def setUp(self):
+        self.rec = RDFRecord(read_file('data/test_rec_full.xml'))
+        self.pub = self.rec.uri
+
+    def test_to_graph(self):
+        triples = list(category_triples("Physics"))
+        g = to_graph(triples + triples)
+        self.assertIsInstance(g, Graph)
+        self.assertEqual(set(g), set(triples))
+        self.assertEqual(len(to_graph([])), 0)
+
+    def test_module_triples(self):
+        cat = get_category_uri("Physics")
+        self.assertEqual(
+            set(category_triples("Physics")),
+            set([(cat, RDF.type, WOS.Category), (cat, RDFS.label, Literal("Physics"))])
+        )
+        kwp = keyword_plus_uri("SEMANTIC WEB")
+        self.assertIn((self.pub, WOS.hasKeywordPlus, kwp), set(keyword_plus_triples("SEMANTIC WEB", self.pub)))
+        g = to_graph(grant_triples(self.rec.grants()[0], self.pub))
+        funder = D['funder-research-council']
+        grant = D['grant-research-council-12-345']
+        self.assertIn((grant, VIVO.relates, funder), g)
+        self.assertIn((grant, VIVO.relates, self.pub), g)
+        self.assertEqual(list(grant_triples({"ids": ["1"]}, self.pub)), [])
+
+    def test_authorship_triples(self):
+        g = to_graph(self.rec.authorship_triples())
+        first, second, third = [self.rec.aship_uri(rank) for rank in ('1', '2', '3')]
+        self.assertEqual(set(g.subjects(RDF.type, VIVO.Authorship)), set([first, second, third]))
+        self.assertEqual(g.value(first, RDFS.label), Literal("Hansen, Anna"))
+        self.assertEqual(g.value(first, VIVO.rank), Literal("1"))
+        self.assertEqual(g.value(first, WOS.email), Literal("anna@example.org"))
+        self.assertEqual(g.value(first, WOS.reprint), Literal("Y"))
+        # Missing values don't make triples.
+        self.assertIsNone(g.value(second, WOS.email))
+        self.assertIsNone(g.value(third, WOS.firstName))
+        # Each authorship relates to the publication and its addresses.
+        addr1 = self.rec.addr_uris_from_number('1')[0]
+        addr2 = self.rec.addr_uris_from_number('2')[0]
+        self.assertEqual(set(g.objects(first, VIVO.relates)), set([self.pub, addr1, addr2]))
+        self.assertEqual(set(g.objects(second, VIVO.relates)), set([self.pub, addr2]))
+        self.assertEqual(set(g.objects(third, VIVO.relates)), set([self.pub]))
+
+    def test_addressship_triples(self):
+        g = to_graph(self.rec.addressship_triples())
+        addr1 = self.rec.addr_uri('Tech Univ Denmark, Dept Phys, DK-2800 Lyngby, Denmark', '1')
+        addr2 = self.rec.addr_uri('Syracuse Univ, Syracuse, NY 13244 USA', '2')
+        self.assertEqual(set(g.subjects(RDF.type, WOS.Address)), set([addr1, addr2]))
+        self.assertEqual(g.value(addr1, WOS.organizationName), Literal("Tech Univ Denmark"))
+        self.assertEqual(g.value(addr2, WOS.sequenceNumber), Literal("2"))
+        self.assertEqual(
+            set(g.objects(addr1, VIVO.relates)),
+            set([
+                self.pub,
+                self.rec.sub_org_uri("Dept Phys, Tech Univ Denmark"),
+                waan_uri("Technical University of Denmark")
+            ])
+        )
+        # Addresses without a sub-organization get the unknown department.
+        unknown = "{}, Syracuse Univ".format(settings.DEPARTMENT_UNKNOWN_LABEL)
+        self.assertIn((addr2, VIVO.relates, self.rec.sub_org_uri(unknown)), g)
+
+    def test_org_triples(self):
+        sub_orgs = to_graph(self.rec.sub_org_triples())
+        suborg = self.rec.sub_org_uri("Dept Phys, Tech Univ Denmark")
+        self.assertEqual(sub_orgs.value(suborg, WOS.subOrganizationName), Literal("Dept Phys"))
+        self.assertEqual(len(set(sub_orgs.subjects(RDF.type, WOS.SubOrganization))), 2)
+        unified = to_graph(self.rec.unified_org_triples())
+        self.assertEqual(
+            set(unified.subjects(RDF.type, WOS.UnifiedOrganization)),
+            set([waan_uri("Technical University of Denmark"), waan_uri("Syracuse University")])
+        )
+
+    def test_venue_triples(self):
+        g = to_graph(self.rec.venue_triples())
+        venue = g.value(self.pub, VIVO.hasPublicationVenue)
+        self.assertIsNotNone(venue)
+        self.assertEqual(g.value(venue, RDF.type), BIBO.Journal)
+        self.assertEqual(g.value(venue, RDFS.label), Literal("JOURNAL OF TEST DATA"))
+        self.assertEqual(g.value(venue, WOS.journalAbbr), Literal("J TEST DATA"))
+        self.assertEqual(g.value(venue, BIBO.issn), Literal("1234-5678"))
+        self.assertIsNone(g.value(venue, BIBO.isbn))
+        # Another record in the same journal shares the venue.
+        other = RDFRecord(read_file('data/test_rec_full.xml').replace('WOS:000456', 'WOS:000457'))
+        self.assertEqual(to_graph(other.venue_triples()).value(other.uri, VIVO.hasPublicationVenue), venue)
+
+    def test_to_triples(self):
+        g = to_graph(self.rec.to_triples())
+        self.assertEqual(g.value(self.pub, RDFS.label), Literal("Mapping test records to RDF"))
+        self.assertEqual(g.value(self.pub, RDF.type), WOS.Article)
+        self.assertEqual(g.value(self.pub, WOS.wosId), Literal("WOS:000456"))
+        self.assertEqual(g.value(self.pub, BIBO.doi), Literal("10.1000/test.456"))
+        self.assertEqual(g.value(self.pub, BIBO.pageStart), Literal("101"))
+        date = g.value(self.pub, VIVO.dateTimeValue)
+        self.assertEqual(g.value(date, RDFS.label), Literal("2016-03-01"))
+        # The graph methods wrap the generators.
+        self.assertEqual(set(self.rec.to()), set(g))
+        self.assertEqual(set(self.rec.authorships()), set(self.rec.authorship_triples()))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,74 @@
+"""
+Segment store tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.segments import SegmentStore, INDEX_NAME
+
+
+class TestSegmentStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_put_get(self):
+        store = SegmentStore(self.path, segment_size=10)
+        store.put("WOS:1", "<REC>one</REC>")
+        store.put("WOS:2", "<REC>two</REC>")
+        # Small segment size rolls to a new segment per record.
+        self.assertEqual(store.index["WOS:2"][0], 1)
+        self.assertEqual(str(store.get("WOS:1")), "<REC>one</REC>")
+        store.put("WOS:1", "<REC>one again</REC>")
+        store.close()
+
+        store = SegmentStore(self.path)
+        self.assertTrue(SegmentStore.exists(self.path))
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.uts(), ["WOS:1", "WOS:2"])
+        self.assertEqual(str(store.get("WOS:1")), "<REC>one again</REC>")
+        self.assertEqual(str(store.get("WOS:2")), "<REC>two</REC>")
+        store.close()
+
+    def test_data_before_index(self):
+        store = SegmentStore(self.path)
+        data = "<REC>{}</REC>".format("x" * 100)
+        for num in range(2000):
+            seg, offset, length = store.put("WOS:{}".format(num), data)
+            # Whatever of the index has reached the file only points
+            # at data that has too.
+            with open(os.path.join(self.path, INDEX_NAME)) as inf:
+                # Skip a line the buffer has only partly written.
+                lines = inf.read().split("\n")[:-1]
+            if lines:
+                last = lines[-1].split("\t")
+                end = int(last[2]) + int(last[3])
+                self.assertTrue(os.path.getsize(store.segment_path(int(last[1]))) >= end)
+        store.close()
+
+    def test_partial_index_line(self):
+        store = SegmentStore(self.path)
+        store.put("WOS:1", "<REC>one</REC>")
+        store.close()
+        # A crash in the middle of writing the next index line.
+        with open(os.path.join(self.path, INDEX_NAME), 'a') as outf:
+            outf.write("WOS:2\t0\t1")
+        store = SegmentStore(self.path)
+        self.assertEqual(store.uts(), ["WOS:1"])
+        store.put("WOS:3", "<REC>three</REC>")
+        store.close()
+
+        store = SegmentStore(self.path)
+        self.assertEqual(store.uts(), ["WOS:1", "WOS:3"])
+        self.assertEqual(str(store.get("WOS:3")), "<REC>three</REC>")
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
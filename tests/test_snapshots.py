@@ -0,0 +1,36 @@
+"""
+Named graph snapshot tests
+"""
+
+import shutil
+import tempfile
+import unittest
+
+from rdflib import Graph, Literal, URIRef
+
+from lib.snapshots import GraphSnapshots
+
+NG = "http://localhost/data/test"
+
+
+class TestGraphSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_save_and_drop(self):
+        snapshots = GraphSnapshots(self.path)
+        self.assertEqual(snapshots.count(NG), None)
+        triples = [(URIRef("http://x.org/s"), URIRef("http://x.org/p"), Literal(i)) for i in range(3)]
+        self.assertEqual(snapshots.save(NG, triples), 3)
+        self.assertEqual(snapshots.count(NG), 3)
+        g = Graph().parse(snapshots.nt_path(NG), format="nt")
+        self.assertEqual(set(g), set(triples))
+        snapshots.drop(NG)
+        self.assertEqual(snapshots.count(NG), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,395 @@
+"""
+WoS client tests against a local mock SOAP server
+"""
+
+import BaseHTTPServer
+from cgi import escape
+from datetime import date, timedelta
+import os
+import re
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import unittest
+import xml.etree.ElementTree as ET
+
+import fetch_pubs_xml
+from lib import harvest
+from lib import wose
+
+TOTAL = 420
+ALL = range(1, TOTAL + 1)
+
+
+def loaded(num):
+    """
+    Load date of a mock record, five a day from 2012-01-01.
+    """
+    return (date(2012, 1, 1) + timedelta(days=(num - 1) // 5)).isoformat()
+
+
+def records_doc(nums, first, count):
+    recs = "".join(
+        "<REC><UID>WOS:{:06d}</UID></REC>".format(num)
+        for num in nums[first - 1:first - 1 + count]
+    )
+    return escape('<records xmlns="http://scientific.thomsonreuters.com/schema/wok5.4/public/FullRecord">{}</records>'.format(recs))
+
+
+class MockWos(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), MockHandler)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.retrieves = 0
+        self.queries = 0
+        self.results = {}
+        # Records every query finds, unless it has a time span.
+        self.all = ALL
+        # Records queries after the first find, when set.
+        self.later = None
+        self.sids = set(["sid"])
+        self.stale_qids = set()
+        # Retrieves from this record on expire the session or make
+        # the query ID stale.
+        self.expire_at = None
+        self.stale_at = None
+        # A retrieve from this record on gets a fault once.
+        self.fail_at = None
+
+
+def fault(msg):
+    return "<Envelope><Body><Fault><faultcode>soap:Server</faultcode><faultstring>{}</faultstring></Fault></Body></Envelope>".format(msg)
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        time.sleep(0.02)
+        status = 200
+        if "<auth:authenticate/>" in body:
+            with server.lock:
+                sid = "sid{}".format(len(server.sids) + 1)
+                server.sids.add(sid)
+            rsp = "<Envelope><Body><return>{}</return></Body></Envelope>".format(sid)
+        else:
+            sid = re.search('SID="([^"]+)"', self.headers.get('Cookie', '')).group(1)
+            first = int(re.search("<firstRecord>(\\d+)</firstRecord>", body).group(1))
+            with server.lock:
+                if (server.expire_at is not None) and (first >= server.expire_at):
+                    server.sids.discard("sid")
+                    server.expire_at = None
+            if sid not in server.sids:
+                status = 500
+                rsp = fault("(WSE0002) Session ID not found: {}".format(sid))
+            elif "<ns2:retrieve " in body:
+                qid = re.search("<queryId>(\\d+)</queryId>", body).group(1)
+                with server.lock:
+                    server.retrieves += 1
+                    if (server.stale_at is not None) and (first >= server.stale_at):
+                        server.stale_qids.add(qid)
+                        server.stale_at = None
+                    failed = (server.fail_at is not None) and (first >= server.fail_at)
+                    if failed:
+                        server.fail_at = None
+                if failed:
+                    status = 500
+                    rsp = fault("(SSE0001) Service unavailable")
+                elif qid in server.stale_qids:
+                    status = 500
+                    rsp = fault("(ESE0003) Invalid queryId: {}".format(qid))
+                else:
+                    rsp = "<Envelope><Body><return><records>{}</records></return></Body></Envelope>".format(
+                        records_doc(server.results.get(qid, server.all), first, 50))
+            else:
+                count = int(re.search("<count>(\\d+)</count>", body).group(1))
+                nums = server.all
+                if (server.later is not None) and (server.queries > 0):
+                    nums = server.later
+                span = re.search("<begin>([-\\d]+)</begin>\\s*<end>([-\\d]+)</end>", body)
+                if span is not None:
+                    nums = [num for num in ALL if span.group(1) <= loaded(num) <= span.group(2)]
+                with server.lock:
+                    server.queries += 1
+                    qid = server.queries
+                    server.results[str(qid)] = nums
+                rsp = ("<Envelope><Body><return><queryId>{}</queryId><recordsFound>{}</recordsFound>"
+                       "<records>{}</records></return></Body></Envelope>").format(
+                           qid, len(nums), records_doc(nums, first, count))
+        with server.lock:
+            server.active -= 1
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml")
+        self.end_headers()
+        self.wfile.write(rsp)
+
+
+class MockWosCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockWos()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:{}/".format(self.server.server_address[1])
+        self.search_url = wose.SEARCH_URL
+        self.rate = wose.MAX_REQUESTS_PER_SECOND
+        self.auth_url = wose.AUTH_URL
+        wose.SEARCH_URL = self.url
+        wose.AUTH_URL = self.url
+        wose.MAX_REQUESTS_PER_SECOND = 100
+
+    def tearDown(self):
+        wose.SEARCH_URL = self.search_url
+        wose.AUTH_URL = self.auth_url
+        wose.MAX_REQUESTS_PER_SECOND = self.rate
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestWose(MockWosCase):
+
+    def test_parallel_pages_in_order(self):
+        serial = wose.raw_query(wose.QUERY.substitute(query="OG=(Test)", count=100), "sid", get_all=True, workers=1)
+        qid, num, recs = wose.raw_query(wose.QUERY.substitute(query="OG=(Test)", count=100), "sid", get_all=True)
+        self.assertEqual(num, TOTAL)
+        uts = [rec.find('./UID').text for rec in recs]
+        self.assertEqual(uts, [rec.find('./UID').text for rec in serial[2]])
+        self.assertEqual(uts[0], "WOS:000001")
+        self.assertEqual(uts[-1], "WOS:{:06d}".format(TOTAL))
+        self.assertTrue(self.server.max_active <= wose.RETRIEVE_WORKERS)
+
+    def test_iter_raw_query(self):
+        qid, num, pages = wose.iter_raw_query(wose.QUERY.substitute(query="OG=(Test)", count=100), "sid", workers=2)
+        # Nothing past the first page is fetched until it's read.
+        self.assertEqual(self.server.retrieves, 0)
+        sizes = [len(recs) for recs in pages]
+        self.assertEqual(sizes[0], 100)
+        self.assertEqual(len(sizes), 8)
+        self.assertEqual(sum(sizes), TOTAL)
+
+    def test_get_pages(self):
+        self.assertEqual(wose.get_pages(100, 420), [101, 151, 201, 251, 301, 351, 401])
+        self.assertEqual(wose.get_pages(100, 150), [101])
+        self.assertEqual(wose.get_pages(100, 151), [101, 151])
+        self.assertEqual(wose.get_pages(100, 100), [])
+
+    def test_rate_ceiling(self):
+        client = wose.Client("sid", url=self.url)
+        started = time.time()
+        pages = list(wose.retrieve_pages(client, "1", [101, 151, 201, 251, 301], workers=4, rate=20))
+        # Five requests at 20 a second take at least 0.2 seconds.
+        self.assertTrue(time.time() - started >= 0.2)
+        self.assertEqual(len(pages), 5)
+        self.assertEqual(wose.get_recs(pages[2])[0].find('./UID').text, "WOS:000201")
+
+
+class TestHarvest(MockWosCase):
+
+    def setUp(self):
+        MockWosCase.setUp(self)
+        self.tmp = tempfile.mkdtemp()
+        self.query = wose.QUERY.substitute(query="OG=(Test)", count=100)
+        self.path = harvest.checkpoint_path(self.tmp, self.query)
+
+    def tearDown(self):
+        MockWosCase.tearDown(self)
+        shutil.rmtree(self.tmp)
+
+    def run_harvest(self, sid="sid", stop_after=None):
+        """
+        UTs written by a harvest, stopping before the page after
+        stop_after pages as if the process died.
+        """
+        session = wose.Session(user="user", password="password", sid=sid)
+        checkpoint = harvest.HarvestCheckpoint(self.path, self.query)
+        written = []
+        for num, recs in enumerate(harvest.harvest(self.query, session, checkpoint, workers=2)):
+            if num == stop_after:
+                break
+            written += [rec.find('./UID').text for rec in recs]
+        return written
+
+    def assertComplete(self, written, total=TOTAL):
+        self.assertEqual(sorted(written), ["WOS:{:06d}".format(num) for num in range(1, total + 1)])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_resume(self):
+        first = self.run_harvest(stop_after=3)
+        self.assertEqual(len(first), 200)
+        checkpoint = harvest.HarvestCheckpoint(self.path, self.query)
+        self.assertEqual(checkpoint.qid, "1")
+        self.assertEqual(checkpoint.last_start, 151)
+        retrieves = self.server.retrieves
+        second = self.run_harvest(sid=checkpoint.sid)
+        self.assertComplete(first + second)
+        # The query isn't sent again and written pages aren't retrieved.
+        self.assertEqual(self.server.queries, 1)
+        self.assertEqual(self.server.retrieves - retrieves, 5)
+
+    def test_last_page(self):
+        # One page after the first, ending on the last record.
+        self.server.all = range(1, 151)
+        self.assertComplete(self.run_harvest(), total=150)
+        self.assertEqual(self.server.retrieves, 1)
+
+    def test_expired_session(self):
+        self.server.expire_at = 250
+        self.assertComplete(self.run_harvest())
+        self.assertEqual(self.server.queries, 1)
+
+    def test_stale_query_id(self):
+        self.server.stale_at = 250
+        self.assertComplete(self.run_harvest())
+        self.assertEqual(self.server.queries, 2)
+
+    def test_count_changed(self):
+        # A record written on the first page is gone when the query is
+        # sent again, so every later record moves back a place.
+        self.server.stale_at = 250
+        self.server.later = ALL[1:]
+        self.assertComplete(self.run_harvest())
+        self.assertEqual(self.server.queries, 2)
+
+    def test_other_fault(self):
+        self.server.fail_at = 250
+        pause = harvest.RETRY_PAUSE
+        harvest.RETRY_PAUSE = 0
+        try:
+            self.assertComplete(self.run_harvest())
+        finally:
+            harvest.RETRY_PAUSE = pause
+        self.assertEqual(self.server.queries, 1)
+
+    def test_fault_codes(self):
+        class Response(object):
+            def __init__(self, msg):
+                self.text = fault(msg)
+        self.assertRaises(wose.SessionException, wose.raise_fault, Response("(WSE0002) Session not found"))
+        self.assertRaises(wose.QueryIdException, wose.raise_fault, Response("(ESE0003) Invalid queryId: 1"))
+        # The wording alone doesn't decide.
+        try:
+            wose.raise_fault(Response("(SSE0001) Session store unavailable"))
+        except wose.WosFault as e:
+            self.assertEqual(type(e), wose.WosFault)
+            self.assertEqual(e.code, "SSE0001")
+
+    def test_other_query(self):
+        self.run_harvest(stop_after=3)
+        checkpoint = harvest.HarvestCheckpoint(self.path, "other")
+        self.assertEqual(checkpoint.qid, None)
+        self.assertFalse(checkpoint.resuming)
+
+
+def window_query(begin, end, count):
+    return wose.QUERY.substitute(query="OG=(Test)", count=count).replace(
+        "</userQuery>", "</userQuery><timeSpan><begin>{}</begin><end>{}</end></timeSpan>".format(begin, end))
+
+
+class TestWindows(MockWosCase):
+
+    def setUp(self):
+        MockWosCase.setUp(self)
+        self.tmp = tempfile.mkdtemp()
+        self.session = wose.Session(user="user", password="password", sid="sid")
+
+    def tearDown(self):
+        MockWosCase.tearDown(self)
+        shutil.rmtree(self.tmp)
+
+    def new_session(self):
+        session = wose.Session(user="user", password="password")
+        session.authenticate()
+        return session
+
+    def test_month_windows(self):
+        self.assertEqual(list(harvest.month_windows("2012-01-15", "2012-03-10")), [
+            ("2012-01-15", "2012-01-31"), ("2012-02-01", "2012-02-29"), ("2012-03-01", "2012-03-10")
+        ])
+        self.assertEqual(harvest.split_window("2012-01-01", "2012-01-31"), [
+            ("2012-01-01", "2012-01-16"), ("2012-01-17", "2012-01-31")
+        ])
+
+    def test_plan_windows(self):
+        windows = harvest.plan_windows(window_query, self.session, "2011-12-01", "2012-06-30", limit=100)
+        self.assertEqual(sum(num for begin, end, num in windows), TOTAL)
+        self.assertTrue(all(num <= 100 for begin, end, num in windows))
+        # Months without records are left out.
+        self.assertEqual(windows[0][0], "2012-01-01")
+        for before, after in zip(windows, windows[1:]):
+            self.assertTrue(before[1] < after[0])
+
+    def harvest_plan(self, windows):
+        plan = harvest.HarvestPlan(self.tmp, "OG=(Test)", window_query)
+        plan.planned(windows)
+        written = []
+
+        def write(recs):
+            written.extend(rec.find('./UID').text for rec in recs)
+
+        harvest.harvest_windows(plan, self.new_session, write, workers=3)
+        self.assertEqual(os.listdir(self.tmp), [])
+        return written
+
+    def test_harvest_windows(self):
+        windows = harvest.plan_windows(window_query, self.session, "2012-01-01", "2012-03-31", limit=100)
+        written = self.harvest_plan(windows)
+        self.assertEqual(sorted(written), ["WOS:{:06d}".format(num) for num in ALL])
+        # One session per worker at most.
+        self.assertTrue(len(self.server.sids) <= 4)
+
+    def test_overlapping_windows(self):
+        written = self.harvest_plan([["2012-01-01", "2012-01-20", 100], ["2012-01-10", "2012-01-31", 110]])
+        self.assertEqual(sorted(written), ["WOS:{:06d}".format(num) for num in range(1, 156)])
+
+
+class TestHarvestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.manifest = harvest.HarvestManifest(os.path.join(self.tmp, harvest.MANIFEST_NAME))
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.tmp)
+
+    def test_last_harvest(self):
+        self.assertEqual(self.manifest.last_harvest("OG=(Test)"), None)
+        self.manifest.harvested("OG=(Test)", "2012-03-31")
+        self.manifest.harvested("OG=(Test)", "2012-02-29")
+        self.assertEqual(self.manifest.last_harvest("OG=(Test)"), "2012-03-31")
+        self.assertEqual(self.manifest.last_harvest("OG=(Other)"), None)
+
+    def test_unfinished(self):
+        self.manifest.begun("OG=(Test)", "2012-01-01", "2012-03-31")
+        self.assertEqual(self.manifest.unfinished("OG=(Test)", "2012-01-01"), "2012-03-31")
+        self.assertEqual(self.manifest.unfinished("OG=(Test)", "2012-02-01"), None)
+        self.manifest.harvested("OG=(Test)", "2012-03-31")
+        self.assertEqual(self.manifest.unfinished("OG=(Test)", "2012-01-01"), None)
+
+    def test_skip_unchanged(self):
+        recs = [ET.fromstring("<REC><UID>WOS:{:06d}</UID><title>A</title></REC>".format(num)) for num in (1, 2, 3)]
+        self.assertEqual(fetch_pubs_xml.write_page(recs, self.tmp, manifest=self.manifest, incremental=True), 3)
+        self.assertEqual(fetch_pubs_xml.write_page(recs, self.tmp, manifest=self.manifest, incremental=True), 0)
+        recs[1].find('./title').text = "B"
+        os.remove(fetch_pubs_xml.get_path("WOS:000003", base_path=self.tmp))
+        # Changed and missing records are written again.
+        self.assertEqual(fetch_pubs_xml.write_page(recs, self.tmp, manifest=self.manifest, incremental=True), 2)
+        # Without incremental everything is.
+        self.assertEqual(fetch_pubs_xml.write_page(recs, self.tmp, manifest=self.manifest), 3)
+
+if __name__ == '__main__':
+    unittest.main()
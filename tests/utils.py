@@ -1,4 +1,9 @@
 import os
+import re
+
+from rdflib import Graph
+
+from lib import backend
 
 # Directory where test data is stored.
 TEST_PATH = os.path.join(
@@ -7,4 +12,50 @@ TEST_PATH = os.path.join(
 
 def read_file(path):
     with open(os.path.join(TEST_PATH, path)) as inf:
-        return inf.read()
\ No newline at end of file
+        return inf.read()
+
+
+class StubStore(backend.SyncVStore):
+    """
+    In-memory stand-in for VIVO. Named graphs are sets of N-Triples
+    lines, updates are recorded as (operation, named graph, lines) and
+    reads are counted.
+    """
+
+    def __init__(self, snapshot_path):
+        self.snapshot_path = snapshot_path
+        self.graphs = {}
+        self.updates = []
+        self.reads = 0
+
+    def update(self, q):
+        op = q.split(" ", 1)[0]
+        named_graph = re.search("GRAPH <([^>]+)>", q).group(1)
+        lines = q.split("{\n", 1)[1].rsplit("} }", 1)[0].splitlines(True)
+        graph = self.graphs.setdefault(named_graph, set())
+        if op == "INSERT":
+            graph.update(lines)
+        else:
+            graph.difference_update(lines)
+        self.updates.append((op, named_graph, len(lines)))
+
+    def count_triples(self, named_graph):
+        self.reads += 1
+        return len(self.graphs.get(named_graph, ()))
+
+    def iter_existing(self, named_graph, size=None, count=None):
+        self.reads += 1
+        g = Graph()
+        g.parse(data="".join(self.graphs.get(named_graph, ())), format="nt")
+        return iter(g)
+
+
+def use_store(vstore):
+    """
+    Make backend.get_store() hand out vstore in this process.
+    """
+    backend._store_pools[os.getpid()] = backend.StorePool(lambda: vstore, size=1)
+
+
+def drop_store():
+    backend._store_pools.pop(os.getpid(), None)
@@ -25,16 +25,12 @@ def get_category_uri(name):
 
 
 def get_journals():
-    q = rq_prefixes + """
-
-    select ?j ?issn
-    where {
+    where = """
         ?j bibo:issn ?issn .
-    }
     """
     vstore = backend.get_store()
     d = {}
-    for row in vstore.query(q):
+    for row in vstore.cursor_select("?j ?issn", where, "j", prefixes=rq_prefixes):
         d[row.issn.toPython()] = row.j
     return d
 